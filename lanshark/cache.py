@@ -2,6 +2,8 @@
 # vim: set fileencoding=utf-8 :
 """Generic cache decorator with some special features
 ...and limitations ;)"""
+from __future__ import with_statement
+import threading
 import time
 
 DEBUG = True
@@ -14,6 +16,9 @@ class _Cached:
         self.max = max_items
         self.results = {}
         self.heap = []
+        # the function itself runs unlocked, concurrent misses of
+        # the same key just call it more than once
+        self.lock = threading.Lock()
         self.stats = stats
         if stats:
             self.hits = 0
@@ -21,22 +26,28 @@ class _Cached:
 
     def __call__(self, *args, **kwargs):
         if "reset_cache" in kwargs:
-            self.results = {}
-            self.heap = []
+            with self.lock:
+                self.results = {}
+                self.heap = []
             return
-        hash_ = hash(args)
+        # key by the arguments themselves, hash collisions must not
+        # return the result of a different call
+        key = args
         t = time.time()
-        while self.heap and self.heap[0][0] < t:
-            del self.results[self.heap.pop(0)[1]]
-        if hash_ in self.results:
-            if self.stats: self.hits += 1
-            return self.results[hash_]
-        if self.stats: self.misses += 1
+        with self.lock:
+            while self.heap and self.heap[0][0] < t:
+                self.results.pop(self.heap.pop(0)[1], None)
+            if key in self.results:
+                if self.stats: self.hits += 1
+                return self.results[key]
+            if self.stats: self.misses += 1
         result = self.func(*args, **kwargs)
-        self.results[hash_] = result
-        self.heap.append((t + self.timeout, hash_))
-        if len(self.heap) > self.max:
-            del self.results[self.heap.pop(0)[1]]
+        with self.lock:
+            if key not in self.results:
+                self.heap.append((t + self.timeout, key))
+            self.results[key] = result
+            if len(self.heap) > self.max:
+                self.results.pop(self.heap.pop(0)[1], None)
         return result
 
 def cached(timeout=600, max_items=128, stats=False):
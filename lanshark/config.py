@@ -79,10 +79,38 @@ class Config(configuration.Config):
     NETWORK_NAME = String("HELO",
             "Word to use for discovery, might act as simple password")
     CACHE_TIMEOUT = Integer(600, "HTTP cache time to live")
+    LISTING_CACHE = Integer(128,
+            "Number of directory listings the daemon keeps ready to send, "
+            "0 disables the cache")
+    HTTP_EVENT_LOOP = Boolean(False,
+            "Serve http from an event loop instead of a thread per "
+            "connection, scales to many idle and downloading clients")
+    HTTP_THREADS = Integer(32,
+            "Number of threads serving http connections, or only handling "
+            "their requests when using the event loop")
+    HTTP_QUEUE = Integer(64,
+            "Maximal number of http connections waiting for a free thread, "
+            "at least 1, further ones are answered with 503 Service "
+            "Unavailable. Not used by the event loop")
     SHARE_PATH = String("", "Path to the files you want to share")
     INCOMING_PATH = String("", "Path to store the downloaded files")
     MAX_SEARCH_RESULTS = Integer(128,
             "Maximal number of search results per peer")
+    MAX_SEARCH_TIME = Integer(1000,
+            "Maximal time in ms spent looking for the results of a search")
+    SEARCH_THREADS = Integer(2,
+            "Number of threads answering search queries")
+    SEARCH_QUEUE = Integer(32,
+            "Maximal number of search queries waiting to be answered, "
+            "further ones are dropped")
+    PEER_SEARCH_RATE = Integer(10,
+            "Maximal number of search queries per second answered for "
+            "every peer, bursts of twice as many are allowed. 0 disables "
+            "the limit")
+    PEER_DISCOVER_RATE = Integer(5,
+            "Maximal number of discovery queries per second answered for "
+            "every peer, bursts of twice as many are allowed. 0 disables "
+            "the limit")
     FOLDER_IMAGES = StringList([r"\.?folder\.(png|jpg|gif|img)$",
                          r"cover\.(png|jpg|gif)$",
                          r"(cover\-)?front\.(png|jpg|gif)$",
@@ -97,10 +125,21 @@ class Config(configuration.Config):
     RESOLVE_HOSTS = Boolean(False, "Resolve hostnames")
     INDEX_INTERVAL = Integer(3600,
             "Interval to update the fileindex in seconds")
+    INDEX_THREADS = Integer(1,
+            "Number of threads listing directories while updating the "
+            "fileindex, more threads help on network shares and raid arrays")
+    INDEX_SHARDS = Integer(1,
+            "Number of processes the fileindex is split across, searches "
+            "run on all of them in parallel to use multiple cores")
+    INDEX_INOTIFY = Boolean(True,
+            "Keep the fileindex up to date using inotify (linux only)")
     GUI_ICON_SIZE = Integer(48, "Icon size in the gtkui")
     # thats a little hacky but works well ;)
     PID_FILE = String(os.path.join("$configdir", "lanshark.pid"),
             "Location of the pid file")
+    INDEX_FILE = String(os.path.join("$configdir", "fileindex"),
+            "Location of the fileindex snapshot which allows answering "
+            "searches right after startup. Leave empty to disable")
     SOCKET_TIMEOUT = Integer(5000, "The timeout of tcp sockets in ms")
     VIDEO_PLAYER = String(get_mediaplayer(),
             "Command to play video files %s gets replaced with "
@@ -137,6 +176,7 @@ class Config(configuration.Config):
         configuration.Config.__init__(self)
         self.dir = os.path.dirname(path)
         self.PID_FILE = self.PID_FILE.replace("$configdir", self.dir)
+        self.INDEX_FILE = self.INDEX_FILE.replace("$configdir", self.dir)
         if os.path.exists(path):
             self.load(path)
             if self.VERSION < self.__class__.VERSION.default:
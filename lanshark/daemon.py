@@ -1,15 +1,30 @@
 #!/usr/bin/env python
 # vim: set fileencoding=utf-8 :
 """The Lanshark Daemon serves files, discovery, and search requests"""
+from __future__ import with_statement
 import BaseHTTPServer
+import array
 import cgi
+import collections
+import email.utils
+import errno
+import hashlib
+import itertools
+import marshal
 import mimetypes
+import multiprocessing
 import os
 import posixpath
+import Queue
+import random
 import re
-import shutil, socket, SocketServer, stat
+import select
+import shutil, socket, SocketServer
+import sre_constants, sre_parse
 import threading
+import time
 import urllib, urllib2
+import zlib
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -22,7 +37,9 @@ from lanshark.config import config
 import logging
 logger = logging.getLogger('lanshark')
 
+from lanshark import dirent
 from lanshark import icons
+from lanshark import inotify
 from lanshark import network
 from lanshark import sendfile
 
@@ -32,110 +49,1086 @@ socket.getaddrinfo = cached(config.CACHE_TIMEOUT, stats=config.debug)(
 
 
 iconpath = os.path.join(config.DATA_PATH, "icons", "32x32")
-iconfactory = icons.URLIconFactory(iconpath, "/__data__/icons/128x128/", ".png")
+iconfactory = icons.URLIconFactory(iconpath, "/__data__/icons/128x128/", ".png",
+        versioned=True)
 hidden_files = [re.compile(pattern) for pattern in config.HIDDEN_FILES]
 
 def hidden(filename):
     return any(pattern.match(filename) for pattern in hidden_files)
 
+@cached(config.CACHE_TIMEOUT, 256, stats=config.debug)
+def compile_search(what):
+    """compiles the regular expression of a search query"""
+    return re.compile(what, re.IGNORECASE)
+
+metacharacters = re.compile(r"[.^$*+?{}\[\]\\|()]")
+
+def trigrams(text):
+    """returns the set of lower case trigrams of text"""
+    text = text.lower()
+    return set(text[i:i+3] for i in xrange(len(text) - 2))
+
+def literals(pattern, flags=0):
+    """
+    returns literal fragments of the regular expression pattern
+    which are contained in every string it matches
+    """
+    fragments = []
+    def walk(parsed):
+        fragment = []
+        for op, av in parsed:
+            if op == sre_constants.LITERAL:
+                fragment.append(unichr(av))
+                continue
+            fragments.append(u"".join(fragment))
+            fragment = []
+            if op == sre_constants.SUBPATTERN:
+                walk(av[1])
+            elif op in (sre_constants.MAX_REPEAT,
+                    sre_constants.MIN_REPEAT) and av[0] > 0:
+                walk(av[2])
+        fragments.append(u"".join(fragment))
+    walk(sre_parse.parse(pattern, flags))
+    return filter(None, fragments)
+
+def prefix_matcher(exp):
+    """
+    returns a function that does the same as exp.match without using re
+    if exp is a plain ascii literal, None otherwise
+    """
+    if metacharacters.search(exp.pattern) or exp.flags & ~re.IGNORECASE:
+        return None
+    try:
+        literal = unicode(exp.pattern)
+        literal.encode("ascii")
+    except UnicodeError:
+        return None
+    if not exp.flags & re.IGNORECASE:
+        return lambda name: name.startswith(literal)
+    literal = literal.lower()
+    n = len(literal)
+    def match(name):
+        prefix = name[:n]
+        if prefix.lower() != literal:
+            return False
+        # re only ignores the case of ascii characters
+        try:
+            prefix.encode("ascii")
+        except UnicodeError:
+            return False
+        return True
+    return match
+
+def pack(names):
+    """packs a list of names into a single string"""
+    return "\0".join(sorted(names))
+
+def unpack(names):
+    """returns the list of names packed by pack"""
+    return names and names.split("\0") or []
+
+def decode(names):
+    """
+    decodes packed names from the filesystem encoding,
+    names that can not be decoded are left out
+    """
+    try:
+        return names.decode(config.FS_ENCODING)
+    except UnicodeDecodeError:
+        decoded = []
+        for name in unpack(names):
+            try:
+                decoded.append(name.decode(config.FS_ENCODING))
+            except UnicodeDecodeError:
+                if config.debug:
+                    logger.exception("error while indexing file %r", name)
+        return u"\0".join(decoded)
+
+def containing(names, lower, fragment):
+    """
+    yields the names containing fragment, names are packed with a leading
+    separator and lower is their lower case version
+    """
+    start = lower.find(fragment)
+    while start != -1:
+        begin = lower.rfind(u"\0", 0, start + 1) + 1
+        end = lower.find(u"\0", start + len(fragment))
+        if end == -1:
+            end = len(lower)
+        yield names[begin:end]
+        start = lower.find(fragment, end)
+
+class Overlay(object):
+    """
+    A layer of changes over the dict base. Reads fall through to base for
+    the keys that weren't changed, merge writes the changes into base.
+    """
+    deleted = object()
+
+    def __init__(self, base):
+        self.base = base
+        # key -> new value or deleted
+        self.changes = {}
+
+    def __contains__(self, key):
+        if key in self.changes:
+            return self.changes[key] is not self.deleted
+        return key in self.base
+
+    def __getitem__(self, key):
+        if key in self.changes:
+            value = self.changes[key]
+            if value is self.deleted:
+                raise KeyError(key)
+            return value
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.changes[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.changes[key] = self.deleted
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def merge(self):
+        """writes the changes into base and returns it"""
+        for key, value in self.changes.iteritems():
+            if value is self.deleted:
+                del self.base[key]
+            else:
+                self.base[key] = value
+        self.changes = {}
+        return self.base
+
+# the costs of search queries
+CHEAP, EXPENSIVE, PATHOLOGICAL = range(3)
+
+# names are short, matching them may take up to len(name) ** MAX_DEGREE steps,
+# searches with a higher degree are expensive even with a trigram to go by
+MAX_DEGREE = 2
+
+def first_literal(parsed):
+    """returns the lower case literal parsed starts with or None"""
+    while parsed:
+        op, av = parsed[0]
+        if op == sre_constants.LITERAL:
+            return unichr(av).lower()
+        if op != sre_constants.SUBPATTERN:
+            return None
+        parsed = av[1]
+    return None
+
+def degree(parsed, last=False):
+    """
+    returns the degree of the polynomial bounding the backtracking of the
+    parsed regular expression or None if it can backtrack exponentially.
+    Every variable repeat or alternation adds one, counted repeats multiply
+    and variable repeats of anything that isn't a fixed width sequence are
+    exponential. An alternation whose branches start with different
+    literals is free, at most one of them can match. So is a variable
+    repeat ending the whole expression, nothing after it can fail.
+    """
+    total = 0
+    for i, (op, av) in enumerate(parsed):
+        if op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT):
+            inner = degree(av[2])
+            if inner is None:
+                return None
+            if av[0] == av[1]:
+                total += av[0] * inner
+                continue
+            low, high = av[2].getwidth()
+            if inner or low != high:
+                return None
+            if not (last and i == len(parsed) - 1):
+                total += 1
+        elif op in (sre_constants.SUBPATTERN, sre_constants.ASSERT,
+                sre_constants.ASSERT_NOT):
+            inner = degree(av[1])
+            if inner is None:
+                return None
+            total += inner
+        elif op == sre_constants.BRANCH:
+            inner = [degree(branch) for branch in av[1]]
+            if None in inner:
+                return None
+            firsts = [first_literal(branch) for branch in av[1]]
+            if None in firsts or len(set(firsts)) < len(firsts):
+                total += 1
+            total += max(inner)
+        elif op == sre_constants.GROUPREF_EXISTS:
+            inner = [degree(branch) for branch in av[1:] if branch]
+            if None in inner:
+                return None
+            total += 1 + max(inner)
+    return total
+
+@cached(config.CACHE_TIMEOUT, 256, stats=config.debug)
+def classify(pattern, flags):
+    """
+    estimates the cost of searching for the regular expression pattern:
+    CHEAP if it can be narrowed down using the trigram index, EXPENSIVE
+    if every name has to be matched or it backtracks with a high polynomial
+    like .*.*.*x and PATHOLOGICAL if it can backtrack exponentially like
+    (a+)+
+    """
+    cost = degree(sre_parse.parse(pattern, flags), True)
+    if cost is None:
+        return PATHOLOGICAL
+    if cost > MAX_DEGREE:
+        return EXPENSIVE
+    if prefix_matcher(re.compile(pattern, flags)):
+        return CHEAP
+    if any(len(fragment) > 2 for fragment in literals(pattern, flags)):
+        return CHEAP
+    return EXPENSIVE
+
+class NameIndex(object):
+    """
+    The searchable part of the file index. Every directory is stored once
+    as a node holding its path and the names of its entries packed into a
+    single string, full paths are only built for search results. A trigram
+    index maps to the nodes whose names contain the trigram.
+    It is patched in place, searches take a snapshot of the nodes they
+    look at so patches neither wait for them nor change what they see.
+    """
+    def __init__(self):
+        # node id -> (directory path, packed names)
+        self.nodes = {}
+        # directory path -> node id
+        self.ids = {}
+        self.next_id = 0
+        # trigram -> array of node ids, built by compact
+        self.postings = {}
+        # trigram -> set of the ids of nodes added since the last compact
+        self.recent = {}
+        # number of nodes replaced or added since the last compact
+        self.changes = 0
+        # guards the nodes, ids and recent postings, only patch changes them
+        self.lock = threading.Lock()
+
+    def patch(self, listings):
+        """
+        replaces the nodes of the directories in listings
+        (path -> packed names or None), returns self
+        """
+        added = []
+        with self.lock:
+            for path, names in listings.iteritems():
+                if path in self.ids:
+                    del self.nodes[self.ids.pop(path)]
+                    self.changes += 1
+                if names:
+                    self.nodes[self.next_id] = (path, names)
+                    self.ids[path] = self.next_id
+                    added.append((self.next_id, names))
+                    self.next_id += 1
+                    self.changes += 1
+        if self.changes > len(self.nodes) / 4:
+            self.compact()
+            return self
+        grams = [(id, trigrams(decode(names))) for id, names in added]
+        with self.lock:
+            for id, names in grams:
+                for gram in names:
+                    if gram in self.recent:
+                        self.recent[gram].add(id)
+                    else:
+                        self.recent[gram] = set([id])
+        return self
+
+    def compact(self):
+        """rebuilds the trigram postings, dropping replaced nodes"""
+        postings = {}
+        # patch is the only writer, so nodes can't change meanwhile
+        for id, (path, names) in self.nodes.iteritems():
+            for gram in trigrams(decode(names)):
+                if gram in postings:
+                    postings[gram].append(id)
+                else:
+                    postings[gram] = array.array("i", [id])
+        with self.lock:
+            self.postings = postings
+            self.recent = {}
+            self.changes = 0
+
+    def candidates(self, fragments):
+        """
+        returns a list of the ids of the nodes that might contain names
+        with all the fragments, or None if the fragments are too short to
+        use the trigram index. The lock has to be held.
+        """
+        grams = set()
+        for fragment in fragments:
+            grams.update(trigrams(fragment))
+        if not grams:
+            return None
+        def count(gram):
+            return len(self.postings.get(gram, ())) + \
+                    len(self.recent.get(gram, ()))
+        gram = min(grams, key=count)
+        return list(itertools.chain(self.postings.get(gram, ()),
+                self.recent.get(gram, ())))
+
+    def search(self, exp, deadline=None, limit=None):
+        """
+        yields the paths of the files whose name matches exp, stops
+        after limit results or once time.time() passes deadline
+        """
+        found = 0
+        match = prefix_matcher(exp)
+        if match:
+            literal = exp.pattern.lower()
+            grams = [literal]
+            # names start after a separator
+            fragments = literal and [u"\0" + literal] or []
+        else:
+            match = exp.match
+            grams = [fragment.lower() for fragment in
+                    literals(exp.pattern, exp.flags)]
+            # looking for short fragments costs more than it saves
+            fragments = sorted([fragment for fragment in grams
+                if len(fragment) > 2], key=len, reverse=True)
+        with self.lock:
+            ids = self.candidates(grams)
+            if ids is None:
+                nodes = self.nodes.values()
+            else:
+                nodes = [self.nodes[id] for id in ids if id in self.nodes]
+        for path, names in nodes:
+            if deadline and time.time() > deadline:
+                logger.debug("search for %r ran out of time", exp.pattern)
+                return
+            names = decode(names)
+            if not names:
+                continue
+            if fragments:
+                names = u"\0" + names
+                lower = names.lower()
+                if not all(fragment in lower for fragment in fragments):
+                    continue
+                names = containing(names, lower, fragments[0])
+            else:
+                names = names.split(u"\0")
+            try:
+                path = path.decode(config.FS_ENCODING)
+            except UnicodeDecodeError:
+                continue
+            for name in names:
+                if match(name):
+                    yield path + name
+                    found += 1
+                    if found == limit:
+                        return
+
+def shard(connection):
+    """the main loop of a ShardedIndex worker process"""
+    index = NameIndex()
+    while True:
+        message = connection.recv()
+        if message is None:
+            return
+        if message[0] == "patch":
+            index = index.patch(message[1])
+            continue
+        pattern, flags, limit, deadline = message[1:]
+        try:
+            results = list(index.search(re.compile(pattern, flags),
+                deadline, limit))
+        except Exception, e:
+            results = e
+        connection.send(results)
+
+class ShardedIndex(object):
+    """
+    Splits the directories of the file index across worker processes
+    holding a NameIndex each. Searches run on all shards in parallel so
+    big indexes use every core and long searches don't hold the GIL of
+    the daemon. Unlike NameIndex it is patched in place.
+    """
+    # seconds to wait for the results of a shard once the deadline passed
+    grace = 1.0
+    # seconds to wait for the results of a search without deadline
+    timeout = 10.0
+
+    def __init__(self, count):
+        self.connections = []
+        self.processes = []
+        # guard sending to the shards, one each
+        self.locks = []
+        # the reply queues of the searches sent to each shard, in order
+        self.pending = []
+        self.receivers = []
+        for i in xrange(count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=shard, args=(child, ))
+            process.daemon = True
+            process.start()
+            child.close()
+            self.connections.append(connection)
+            self.processes.append(process)
+            self.locks.append(threading.Lock())
+            self.pending.append(collections.deque())
+            receiver = threading.Thread(target=self.receive, args=(i, ))
+            receiver.setDaemon(True)
+            receiver.start()
+            self.receivers.append(receiver)
+
+    def receive(self, i):
+        """passes the results sent by shard i to the searches waiting"""
+        while True:
+            try:
+                results = self.connections[i].recv()
+            except (EOFError, IOError):
+                return
+            with self.locks[i]:
+                replies = self.pending[i].popleft()
+            replies.put(results)
+
+    def patch(self, listings):
+        """
+        replaces the nodes of the directories in listings
+        (path -> packed names or None) in their shards, returns self
+        """
+        shards = [{} for connection in self.connections]
+        for path, names in listings.iteritems():
+            shards[hash(path) % len(shards)][path] = names
+        for i, listings in enumerate(shards):
+            if listings:
+                with self.locks[i]:
+                    self.connections[i].send(("patch", listings))
+        return self
+
+    def search(self, exp, deadline=None, limit=None):
+        """
+        yields the paths of the files whose name matches exp, stops
+        after limit results or once time.time() passes deadline
+        """
+        replies = Queue.Queue()
+        sent = 0
+        for i, connection in enumerate(self.connections):
+            with self.locks[i]:
+                try:
+                    connection.send(("search", exp.pattern, exp.flags,
+                        limit, deadline))
+                except IOError, e:
+                    logger.error("Could not search shard %i: %s", i, e)
+                    continue
+                self.pending[i].append(replies)
+                sent += 1
+        if deadline:
+            timeout = deadline + self.grace
+        else:
+            timeout = time.time() + self.timeout
+        shards = []
+        while len(shards) < sent:
+            try:
+                shards.append(replies.get(True,
+                    max(timeout - time.time(), 0)))
+            except Queue.Empty:
+                logger.warn("search for %r timed out on %i shards",
+                        exp.pattern, sent - len(shards))
+                break
+        for results in shards:
+            if isinstance(results, Exception):
+                raise results
+            for result in results:
+                yield result
+                if limit is not None:
+                    limit -= 1
+                    if not limit:
+                        return
+
+    def close(self):
+        """stops the worker processes"""
+        for i, connection in enumerate(self.connections):
+            with self.locks[i]:
+                try:
+                    connection.send(None)
+                except IOError:
+                    pass
+        for process in self.processes:
+            process.join()
+        for receiver in self.receivers:
+            receiver.join()
+        for connection in self.connections:
+            connection.close()
+
 class FileIndex(threading.Thread):
     """
     The fileindex offers fast searching over
     a periodicaly updated file index
     """
+    snapshot_version = 2
+
     def __init__(self, path):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.path = path
         if not self.path.endswith("/"):
             self.path += "/"
-        self.file_index = {}
+        if config.INDEX_SHARDS > 1:
+            self.file_index = ShardedIndex(config.INDEX_SHARDS)
+        else:
+            self.file_index = NameIndex()
+        # directory path -> ((mtime, inode), packed entries) as of the
+        # last scan
+        self.dirs = {}
+        # incremented every time a changed index is swapped in
+        self.generation = 0
         # makes sure no search queries are answered before the index is ready
         self.index_event = threading.Event()
         self.wait_event = threading.Event()
+        self.forced = False
+        self.inotify = None
+        if config.INDEX_INOTIFY and inotify.available:
+            try:
+                self.inotify = inotify.Inotify()
+            except OSError:
+                logger.exception("Could not initialize inotify")
+        # inotify events waiting to be applied by the index thread
+        self.events = []
+        self.events_lock = threading.Lock()
+        # directory path -> watch descriptor and the other way round
+        self.watches = {}
+        self.watched = {}
+        # guards the watches and the visited directories of concurrent walks
+        self.walk_lock = threading.Lock()
+        # results of recent searches, the generation is part of the key
+        # so changes of the index make them unreachable
+        self.results = cached(config.CACHE_TIMEOUT, 256,
+                stats=config.debug)(self.find)
         self.start()
 
     def run(self):
         """updates the fileindex periodically"""
+        if self.inotify:
+            watcher = threading.Thread(target=self.read_events)
+            watcher.setDaemon(True)
+            watcher.start()
+        # answer searches from the snapshot while it is being revalidated
+        if self.load():
+            logger.debug("file index snapshot loaded")
+            self.index_event.set()
         while True:
             logger.debug("updating file index")
-            self.file_index = self.index(self.path, {})
+            self.forced = False
+            if self.rescan():
+                self.save()
             self.index_event.set()
             logger.debug("file index updated")
-            self.wait_event.wait(config.INDEX_INTERVAL)
+            self.wait()
+
+    def wait(self):
+        """
+        waits until the next rescan is due, meanwhile the changes reported
+        by inotify are applied to the index as they happen
+        """
+        timeout = time.time() + config.INDEX_INTERVAL
+        while not self.forced and time.time() < timeout:
+            self.wait_event.wait(timeout - time.time())
             self.wait_event.clear()
+            with self.events_lock:
+                events, self.events = self.events, []
+            if events and not self.apply(events):
+                break
 
     def update(self):
-        """Does a forced asynchronous reset of the file index"""
+        """Does a forced asynchronous rescan of the file index"""
         self.index_event.clear()
+        self.forced = True
         self.wait_event.set()
 
-    def index(self, path, index = None, links = None):
-        """updates the filed_index"""
-        if not index:
-            index = {}
-        if not links:
-            links = []
-        for filename in os.listdir(path):
-            if hidden(filename):
+    def read_events(self):
+        """passes the events of the inotify instance to the index thread"""
+        while True:
+            try:
+                events = self.inotify.read()
+            except OSError, e:
+                if e.errno != errno.EINTR:
+                    logger.exception("Could not read inotify events")
+                    return
+                continue
+            with self.events_lock:
+                self.events += events
+            self.wait_event.set()
+
+    def load(self):
+        """loads the snapshot written by save, returns True on success"""
+        if not config.INDEX_FILE or not os.path.exists(config.INDEX_FILE):
+            return False
+        try:
+            with open(config.INDEX_FILE, "rb") as f:
+                version, path, hidden_files, dirs = marshal.loads(
+                        zlib.decompress(f.read()))
+        except (IOError, EOFError, ValueError, TypeError, zlib.error):
+            logger.exception("Could not load the file index snapshot %s",
+                    config.INDEX_FILE)
+            return False
+        if (version, path, hidden_files) != (self.snapshot_version,
+                self.path, config.HIDDEN_FILES):
+            return False
+        self.commit(dirs, set(dirs))
+        return True
+
+    def save(self):
+        """writes a snapshot of the directory listings to INDEX_FILE"""
+        if not config.INDEX_FILE:
+            return
+        tmp = config.INDEX_FILE + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                f.write(zlib.compress(marshal.dumps((self.snapshot_version,
+                    self.path, config.HIDDEN_FILES, self.dirs)), 1))
+            if os.name == "nt" and os.path.exists(config.INDEX_FILE):
+                os.remove(config.INDEX_FILE)
+            os.rename(tmp, config.INDEX_FILE)
+        except (IOError, OSError):
+            logger.exception("Could not save the file index snapshot %s",
+                    config.INDEX_FILE)
+
+    def rescan(self):
+        """
+        Rescans the share and swaps in the updated index.
+        Only directories whose mtime or inode changed are listed again,
+        searches keep using the old index until the new one is ready.
+        Returns True if any directory was listed again.
+        """
+        dirs = {}
+        changed = set()
+        try:
+            if config.INDEX_THREADS > 1:
+                self.walk(self.path, dirs, changed)
+            else:
+                self.index(self.path, dirs, changed)
+        except OSError:
+            logger.exception("Could not index %s", self.path)
+            return False
+        for path in self.dirs:
+            if path not in dirs:
+                self.unwatch(path)
+                changed.add(path)
+        self.commit(dirs, changed)
+        logger.debug("relisted %i of %i directories", len(changed), len(dirs))
+        return bool(changed)
+
+    def apply(self, events):
+        """
+        applies inotify events to the index, returns False if events
+        were lost and the index needs a full rescan
+        """
+        # only the touched directories are copied
+        dirs = Overlay(self.dirs)
+        changed = set()
+        # the entries of the directories touched by the events
+        listings = {}
+        for wd, mask, cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                logger.warn("inotify queue overflow, rescanning file index")
+                return False
+            path = self.watched.get(wd)
+            if mask & inotify.IN_IGNORED:
+                if path is not None:
+                    del self.watched[wd]
+                    del self.watches[path]
                 continue
+            if path not in dirs or hidden(name):
+                continue
+            if mask & inotify.IN_ISDIR:
+                name += "/"
+            if path not in listings:
+                listings[path] = set(unpack(dirs[path][1]))
+            entries = listings[path]
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                if name not in entries:
+                    entries.add(name)
+                    if name[-1] == "/":
+                        try:
+                            self.index(path + name, dirs, changed)
+                        except OSError:
+                            if config.debug:
+                                logger.exception("Caught an OSError while "
+                                        "indexing %s", path + name)
+            elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                if name in entries:
+                    entries.remove(name)
+                    if name[-1] == "/":
+                        self.forget(path + name, dirs, changed, listings)
+        for path, entries in listings.iteritems():
+            if path in dirs:
+                # not listed by us, let the next rescan verify it
+                dirs[path] = (None, pack(entries))
+                changed.add(path)
+        self.commit(dirs, changed)
+        return True
+
+    def forget(self, path, dirs, changed, listings):
+        """removes path and its subdirectories from dirs"""
+        if path not in dirs:
+            return
+        if path in listings:
+            entries = listings.pop(path)
+        else:
+            entries = unpack(dirs[path][1])
+        del dirs[path]
+        changed.add(path)
+        self.unwatch(path)
+        for filename in entries:
+            if filename[-1] == "/":
+                self.forget(path + filename, dirs, changed, listings)
+
+    def commit(self, dirs, changed):
+        """
+        swaps in the directory listings dirs, or merges them into the
+        current ones if dirs is an Overlay of them, and patches the
+        entries of the changed directories into the index
+        """
+        listings = {}
+        for path in changed:
+            old = path in self.dirs and self.dirs[path][1] or None
+            new = path in dirs and dirs[path][1] or None
+            if old != new:
+                listings[path] = new
+        if isinstance(dirs, Overlay):
+            dirs.merge()
+        else:
+            self.dirs = dirs
+        if listings:
+            self.file_index = self.file_index.patch(listings)
+            self.generation += 1
+
+    def watch(self, path):
+        """adds an inotify watch for the directory path"""
+        if not self.inotify or path in self.watches:
+            return
+        try:
+            wd = self.inotify.add_watch(path, inotify.IN_CREATE |
+                    inotify.IN_DELETE | inotify.IN_MOVED_FROM |
+                    inotify.IN_MOVED_TO | inotify.IN_ONLYDIR)
+        except OSError, e:
+            # most likely max_user_watches has been reached,
+            # the periodic rescans will catch up with the changes
+            logger.debug("Could not watch %s: %s", path, e)
+            return
+        # the same directory might have been watched under another path
+        if wd in self.watched:
+            del self.watches[self.watched[wd]]
+        self.watches[path] = wd
+        self.watched[wd] = path
+
+    def unwatch(self, path):
+        """removes the inotify watch of the directory path"""
+        wd = self.watches.pop(path, None)
+        if wd is not None:
+            del self.watched[wd]
             try:
-                filepath = os.path.join(path, filename)
-                if os.path.isdir(filepath):
-                    filepath += "/"
-                    filename += "/"
-                # we store the keys in unicode!
-                try:
-                    ufilename = filename.decode(config.FS_ENCODING)
-                    ufilepath = filepath.decode(config.FS_ENCODING)
-                except UnicodeDecodeError:
-                    if config.debug:
-                        logger.exception("error while indexing file %r",
-                                filepath)
-                    continue
-                if ufilename in index:
-                    index[ufilename].append(ufilepath)
-                else:
-                    index[ufilename] = [ufilepath]
-
-                if filename[-1] == "/":
-                    real_path = os.path.realpath(filepath)
-                    if real_path != filepath:
-                        if not real_path in links:
-                            links.append(real_path)
-                            self.index(filepath, index, links)
-                    else:
-                        self.index(filepath, index, links)
+                self.inotify.rm_watch(wd)
+            except OSError:
+                pass
+
+    def index(self, path, dirs, changed, links = None):
+        """
+        walks path and stores the listing of every directory in dirs,
+        the paths of the directories that had to be listed go to changed
+        """
+        if links is None:
+            links = set()
+        record, relisted = self.scan(path, links)
+        if record is None:
+            return
+        dirs[path] = record
+        if relisted:
+            changed.add(path)
+        for filepath in self.subdirs(path, record):
+            try:
+                self.index(filepath, dirs, changed, links)
             except OSError:
                 if config.debug:
                     logger.exception("Caught an OSError while indexing %s",
                             path)
-        return index
+
+    def walk(self, path, dirs, changed):
+        """
+        does the same as index but lists sibling directories concurrently
+        using INDEX_THREADS threads, which pays off when the walk is bound
+        by latency like on network shares and raid arrays
+        """
+        tasks = Queue.Queue()
+        results = Queue.Queue()
+        def work():
+            while True:
+                path = tasks.get()
+                if path is None:
+                    return
+                try:
+                    record, relisted = self.scan(path, links)
+                    results.put((path, None, record, relisted,
+                        record and self.subdirs(path, record)))
+                except Exception, e:
+                    results.put((path, e, None, False, None))
+        workers = [threading.Thread(target=work)
+                for i in xrange(config.INDEX_THREADS)]
+        for worker in workers:
+            worker.setDaemon(True)
+            worker.start()
+        links = set()
+        try:
+            root = path
+            tasks.put(path)
+            pending = 1
+            while pending:
+                path, error, record, relisted, subdirs = results.get()
+                pending -= 1
+                if error:
+                    if path == root:
+                        raise error
+                    if config.debug:
+                        logger.error("Caught %r while indexing %s",
+                                error, path)
+                    continue
+                if record is None:
+                    continue
+                dirs[path] = record
+                if relisted:
+                    changed.add(path)
+                for filepath in subdirs:
+                    tasks.put(filepath)
+                    pending += 1
+        finally:
+            for worker in workers:
+                tasks.put(None)
+
+    def scan(self, path, links):
+        """
+        returns the record of the directory path and whether it had to be
+        listed, the record of the last scan is reused if it is unchanged.
+        links holds the (device, inode) of the directories visited so far,
+        the record is None if path is one of them under another name
+        """
+        stats = os.stat(path)
+        with self.walk_lock:
+            if (stats.st_dev, stats.st_ino) in links:
+                return None, False
+            links.add((stats.st_dev, stats.st_ino))
+            # watch before listing so no changes get lost in between
+            self.watch(path)
+        key = (stats.st_mtime, stats.st_ino)
+        record = self.dirs.get(path)
+        if record and record[0] == key:
+            return record, False
+        # the directory might still change within the mtime granularity
+        # of the filesystem, make sure it gets listed again next time
+        if stats.st_mtime > time.time() - 2:
+            key = None
+        return (key, pack(self.listdir(path))), True
+
+    def subdirs(self, path, record):
+        """returns the paths of the subdirectories in record"""
+        return [path + filename for filename in unpack(record[1])
+                if filename[-1] == "/"]
+
+    def listdir(self, path):
+        """returns the visible entries of path, directories end with a /"""
+        entries = []
+        for filename, type in dirent.listdir(path):
+            if hidden(filename):
+                continue
+            if dirent.isdir(path + filename, type):
+                filename += "/"
+            entries.append(filename)
+        return entries
 
     def search(self, exp):
-        """Search for a file matching the regular expression exp"""
+        """
+        Search for files matching the regular expression exp,
+        returns a tuple of (path, size, mtime) tuples
+        """
+        return self.page(exp, 0)[0]
+
+    def page(self, exp, offset):
+        """
+        returns a tuple of the next MAX_SEARCH_RESULTS results matching
+        exp starting at offset and the offset of the page after it, which
+        is None if there are no more results
+        """
         self.index_event.wait()
-        results = 0
-        for name in self.file_index:
-            if exp.match(name):
-                for result in self.file_index[name]:
-                    yield result
-                    results += 1
-                    if results >= config.MAX_SEARCH_RESULTS:
-                        return
+        end = offset + config.MAX_SEARCH_RESULTS
+        # one more to know whether there is another page
+        results = self.results(exp.pattern, exp.flags, self.generation,
+                end + 1)
+        if len(results) > end:
+            return results[offset:end], end
+        return results[offset:end], None
+
+    def iterate(self, exp, limit):
+        """
+        yields up to limit results matching exp as they are found,
+        unlike search the results are not cached
+        """
+        self.index_event.wait()
+        deadline = time.time() + config.MAX_SEARCH_TIME / 1000.0
+        for path in self.file_index.search(exp, deadline, limit):
+            result = self.stat(path)
+            if result:
+                yield result
+
+    def find(self, pattern, flags, generation, limit):
+        """
+        returns up to limit results matching pattern in the current index,
+        as many as can be found within MAX_SEARCH_TIME
+        """
+        deadline = time.time() + config.MAX_SEARCH_TIME / 1000.0
+        results = []
+        for path in self.file_index.search(re.compile(pattern, flags),
+                deadline, limit):
+            result = self.stat(path)
+            if result:
+                results.append(result)
+        return tuple(results)
+
+    def stat(self, path):
+        """
+        returns the (path, size, mtime) of a search result or None if it
+        is gone. Like in the directory listings the size of a directory
+        is the number of its subdirectories and files.
+        """
+        fspath = path.encode(config.FS_ENCODING)
+        try:
+            stats = os.stat(fspath)
+        except OSError:
+            return None
+        if path.endswith("/"):
+            record = self.dirs.get(fspath)
+            if record:
+                entries = unpack(record[1])
+                dirs = len([entry for entry in entries if entry[-1] == "/"])
+                size = (dirs, len(entries) - dirs)
+            else:
+                size = -1
+        else:
+            size = stats.st_size
+        return (path, size, int(stats.st_mtime))
+
+class TokenBucket(object):
+    """Allows rate events per second on average and bursts of burst events"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.time = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                self.tokens + (now - self.time) * self.rate)
+        self.time = now
+
+    def take(self):
+        """returns True if another event is allowed right now"""
+        self.refill()
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class FairQueue(object):
+    """
+    A bounded queue handing out the items put under different keys round
+    robin, so nobody has to wait behind the items of a single busy key.
+    When it's full the key with the most items loses its oldest one.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        # key -> deque of items
+        self.queues = {}
+        # the keys having items in the order they get their next turn
+        self.turns = collections.deque()
+        self.size = 0
+        self.condition = threading.Condition()
+
+    def put(self, key, item):
+        """adds item, returns the item dropped to make room or None"""
+        with self.condition:
+            dropped = None
+            if self.size and self.size >= self.maxsize:
+                busiest = max(self.queues,
+                        key=lambda key: len(self.queues[key]))
+                dropped = self.pop(busiest)
+            if key not in self.queues:
+                self.queues[key] = collections.deque()
+                self.turns.append(key)
+            self.queues[key].append(item)
+            self.size += 1
+            self.condition.notify()
+            return dropped
+
+    def get(self):
+        """blocks until an item is available and returns it"""
+        with self.condition:
+            while not self.size:
+                self.condition.wait()
+            key = self.turns.popleft()
+            item = self.pop(key)
+            if key in self.queues:
+                self.turns.append(key)
+            return item
+
+    def pop(self, key):
+        queue = self.queues[key]
+        item = queue.popleft()
+        self.size -= 1
+        if not queue:
+            del self.queues[key]
+            if key in self.turns:
+                self.turns.remove(key)
+        return item
 
 class UDPService(threading.Thread):
-    """The UDPService handles search and discovery queries"""
+    """
+    The UDPService handles search and discovery queries.
+    Its own thread only receives the queries and answers discovery right
+    away, searches are queued to SEARCH_THREADS worker threads and
+    dropped when the queue is full. The queries of every peer are rate
+    limited and the queued searches are answered round robin by peer.
+    """
+    # maximal number of expensive searches waiting to be answered
+    slow_lane_size = 16
+    # the token buckets of peers are forgotten once there are more
+    max_peers = 1024
+
     def __init__(self, fi):
         threading.Thread.__init__(self)
         self.setDaemon(True)
         self.fileindex = fi
         self.socket = network.broadcast_dgram_socket(config.PORT)
+        self.fast_lane = FairQueue(config.SEARCH_QUEUE)
+        # expensive searches are answered by a thread of their own
+        # so cheap ones don't have to wait behind them
+        self.slow_lane = FairQueue(self.slow_lane_size)
+        # number of searches dropped because they couldn't be answered
+        # in time
+        self.dropped = 0
+        # (kind of query, peer address) -> TokenBucket
+        self.buckets = {}
+        # number of queries ignored because of the rate limits
+        self.limited = 0
 
     def run(self):
+        lanes = [self.fast_lane] * max(config.SEARCH_THREADS, 1) + \
+                [self.slow_lane]
+        for lane in lanes:
+            worker = threading.Thread(target=self.work, args=(lane, ))
+            worker.setDaemon(True)
+            worker.start()
         while True:
             try:
-                msg, addr = self.socket.recvfrom(1024)
+                msg, addr = self.socket.recvfrom(65536)
             except:
                 logger.exception("Couldn't receive data from the socket")
                 continue
@@ -145,6 +1138,20 @@ class UDPService(threading.Thread):
                 logger.exception("UDPService exception: msg=%r addr=%r",
                     msg, addr)
 
+    def work(self, lane):
+        """answers the searches queued to lane"""
+        while True:
+            queued, uwhat, search, addr, batch, offset = lane.get()
+            # the client stopped waiting for results by now
+            if time.time() - queued > config.SEARCH_TIMEOUT:
+                self.drop(uwhat, addr)
+                continue
+            try:
+                self.answer(uwhat, search, addr, batch, offset)
+            except:
+                logger.exception("UDPService exception: search=%r addr=%r",
+                    uwhat, addr)
+
     def process(self, msg, addr):
         if config.debug:
             logger.debug("UDPService: " + repr((addr, msg)))
@@ -152,48 +1159,326 @@ class UDPService(threading.Thread):
             logger.warn("got message from broadcast address")
         #    continue
         if msg == config.NETWORK_NAME:
+            if not self.allow("discover", addr, config.PEER_DISCOVER_RATE):
+                return
             reply = msg + " " + config.HOSTNAME
             self.socket.sendto(reply, addr)
         elif msg.startswith("search %s " % config.NETWORK_NAME):
+            if not self.allow("search", addr, config.PEER_SEARCH_RATE):
+                return
             uwhat = msg[8 + len(config.NETWORK_NAME):]
+            batch = uwhat.startswith(network.BATCH_SEARCH)
+            what = uwhat
+            offset = 0
+            if batch:
+                what = what[len(network.BATCH_SEARCH):]
+                match = network.search_offset.match(what)
+                if match:
+                    offset = int(match.group(1))
+                    what = what[match.end():]
             try:
-                what = uwhat.decode('utf8')
+                what = what.decode('utf8')
             except UnicodeError, e:
-                what = uwhat
                 logger.debug('UDPService: uwhat=%r e=%r', uwhat, e)
             try:
-                search = re.compile(what, re.IGNORECASE)
-                results = self.fileindex.search(search)
-                for result in results:
-                    result = result[len(self.fileindex.path):]
-                    reply = uwhat + ":" + (result).encode("utf8")
-                    self.socket.sendto(reply, addr)
+                search = compile_search(what)
+                cost = classify(search.pattern, search.flags)
             except re.error,e:
                     logger.exception("Recieved an invalid regex from %s", addr)
+                    return
+            if cost == PATHOLOGICAL:
+                logger.warn("Refused to search for %r from %s", uwhat, addr)
+                return
+            if cost == EXPENSIVE:
+                lane = self.slow_lane
+            else:
+                lane = self.fast_lane
+            dropped = lane.put(addr[0], (time.time(), uwhat, search, addr,
+                batch, offset))
+            if dropped:
+                self.drop(dropped[1], dropped[3])
+
+    def allow(self, kind, addr, rate):
+        """
+        returns True if another query of kind from addr is within
+        the rate limit
+        """
+        if rate <= 0:
+            return True
+        key = (kind, addr[0])
+        if key not in self.buckets:
+            if len(self.buckets) >= self.max_peers:
+                # forget the peers which have been quiet for a while
+                for other, bucket in self.buckets.items():
+                    bucket.refill()
+                    if bucket.tokens >= bucket.burst:
+                        del self.buckets[other]
+                while len(self.buckets) >= self.max_peers:
+                    self.buckets.popitem()
+            self.buckets[key] = TokenBucket(rate, rate * 2)
+        if self.buckets[key].take():
+            return True
+        self.limited += 1
+        logger.debug("Ignored %s query from %s, %i queries ignored so far",
+                kind, addr, self.limited)
+        return False
+
+    def drop(self, uwhat, addr):
+        self.dropped += 1
+        logger.debug("Dropped search for %r from %s, %i searches dropped "
+                "so far", uwhat, addr, self.dropped)
+
+    def answer(self, uwhat, search, addr, batch, offset):
+        """
+        sends the results of search to addr, one per datagram or if batch
+        is set as many as fit into a datagram starting at offset, followed
+        by the offset of the next page. Batched results are the path,
+        size and mtime separated by null bytes
+        """
+        results, next = self.fileindex.page(search, offset)
+        if not batch:
+            for result, size, mtime in results:
+                result = result[len(self.fileindex.path):]
+                reply = uwhat + ":" + (result).encode("utf8")
+                self.socket.sendto(reply, addr)
+            return
+        reply = [uwhat]
+        length = len(uwhat)
+        for result, size, mtime in results:
+            result = result[len(self.fileindex.path):].encode("utf8")
+            if isinstance(size, tuple):
+                size = "%i,%i" % size
+            result = "%s\0%s\0%i" % (result, size, mtime)
+            if len(reply) > 1 and \
+                    length + 1 + len(result) > network.DATAGRAM_SIZE:
+                self.socket.sendto("\0".join(reply), addr)
+                reply = [uwhat]
+                length = len(uwhat)
+            reply.append(result)
+            length += 1 + len(result)
+        if len(reply) > 1:
+            self.socket.sendto("\0".join(reply), addr)
+        if next is not None:
+            self.socket.sendto("%s\0\0%i" % (uwhat, next), addr)
+
+byte_range = re.compile(r"^\s*(\d*)-(\d*)\s*$")
+def parse_ranges(header, size, limit=64):
+    """
+    parses the Range header of a request for a file of size bytes into a
+    sorted list of (first, last) byte positions, overlapping and adjacent
+    ranges are merged. returns None if the header is invalid or asks for
+    more than limit pieces and should be ignored and [] if none of the
+    ranges is satisfiable
+    """
+    unit, _, specs = header.partition("=")
+    if unit.strip().lower() != "bytes":
+        return None
+    ranges = []
+    for spec in specs.split(","):
+        if not spec.strip():
+            continue
+        match = byte_range.match(spec)
+        if not match or match.groups() == ("", ""):
+            return None
+        first, last = match.groups()
+        if not first:
+            # the last n bytes
+            length = int(last)
+            if not length:
+                continue
+            first, last = max(size - length, 0), size - 1
+        else:
+            first = int(first)
+            if not last:
+                last = size - 1
+            elif int(last) < first:
+                return None
+            else:
+                last = min(int(last), size - 1)
+        if first < size:
+            ranges.append((first, last))
+    ranges.sort()
+    merged = []
+    for first, last in ranges:
+        if merged and first <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(last, merged[-1][1]))
+        else:
+            merged.append((first, last))
+    if len(merged) > limit:
+        return None
+    return merged
+
+def dirstat(path):
+    """returns the (mtime, inode) of path which change with its entries"""
+    stats = os.stat(path)
+    return stats.st_mtime, stats.st_ino
+
+class ListingCache(object):
+    """
+    Keeps the encoded directory listings of the http service ready to
+    send. A listing stays valid while the directory and its subdirectories
+    keep their mtimes, that covers added, removed and renamed entries.
+    Changed file sizes only show up once it is CACHE_TIMEOUT old.
+    """
+    def __init__(self, size):
+        self.size = size
+        # key -> (expiry time, [(path, stat key)], listing), oldest first
+        self.listings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """returns the listing stored under key or None if it is outdated"""
+        with self.lock:
+            entry = self.listings.pop(key, None)
+            if entry is None:
+                return None
+            self.listings[key] = entry
+        expires, dirs, listing = entry
+        try:
+            if time.time() < expires and \
+                    all(dirstat(path) == stats for path, stats in dirs):
+                return listing
+        except OSError:
+            pass
+        with self.lock:
+            if self.listings.get(key) is entry:
+                del self.listings[key]
+        return None
+
+    def put(self, key, dirs, listing):
+        """
+        stores listing under key, dirs are the (path, stat key) of the
+        directories it was read from
+        """
+        if not self.size:
+            return
+        now = time.time()
+        # the directories might still change within the mtime
+        # granularity of the filesystem
+        if any(stats[0] > now - 2 for path, stats in dirs):
+            return
+        with self.lock:
+            self.listings.pop(key, None)
+            self.listings[key] = (now + config.CACHE_TIMEOUT, dirs, listing)
+            while len(self.listings) > self.size:
+                self.listings.popitem(False)
+
+def compressor(encoding):
+    """returns a zlib compressobj for the content coding gzip or deflate"""
+    if encoding == "gzip":
+        return zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return zlib.compressobj(6)
+
+def compress(data, encoding):
+    """compresses data for the content coding gzip or deflate"""
+    compressobj = compressor(encoding)
+    return compressobj.compress(data) + compressobj.flush()
+
+def data_url(name):
+    """returns the url of the file name in DATA_PATH, versioned by mtime"""
+    try:
+        mtime = os.stat(os.path.join(config.DATA_PATH, name)).st_mtime
+    except OSError:
+        return "/__data__/" + name
+    return "/__data__/%s?v=%x" % (name, int(mtime))
+
+class StaticFiles(object):
+    """
+    Keeps the small static files of the web interface in memory along
+    with their compressed copies, so they are read and compressed once
+    """
+    def __init__(self, max_size=262144):
+        self.max_size = max_size
+        # path -> (stat result, contents, compressed contents by coding)
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        """
+        returns the (stat result, contents, compressed contents by coding)
+        of the file path or None if it is too big or can't be read
+        """
+        try:
+            stats = os.stat(path)
+        except OSError:
+            return None
+        if stats.st_size > self.max_size:
+            return None
+        with self.lock:
+            entry = self.files.get(path)
+        if entry and (entry[0].st_mtime, entry[0].st_size, entry[0].st_ino) \
+                == (stats.st_mtime, stats.st_size, stats.st_ino):
+            return entry
+        try:
+            with open(path, "rb") as f:
+                entry = (os.fstat(f.fileno()), f.read(), {})
+        except IOError:
+            return None
+        with self.lock:
+            self.files[path] = entry
+        return entry
 
 class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """The HTTPRequest handler serves the files/indexes, quite a mess"""
     protocol_version = "HTTP/1.1"
     server_version = "Lanshark"
+    # listings of directories with more entries are streamed
+    stream_entries = 1024
+    # smaller responses are not worth compressing
+    compress_size = 512
+    compressible = re.compile(r"^(text/.*|application/(x-)?javascript|"
+            r"application/json|.*\+xml)$")
+    # seconds browsers may reuse unversioned files of the web interface
+    data_max_age = 3600
+    # seconds an idle or stalled connection may hold a worker,
+    # None for config.SOCKET_TIMEOUT
+    timeout = None
+    # for the (filename, size, icon, mtime) of the entries,
+    # directories come before files when sorting by size
+    sort_keys = {
+        "name": None,
+        "size": lambda entry: (not isinstance(entry[1], tuple), entry[1]),
+        "mtime": lambda entry: entry[3],
+    }
 
     def __init__(self, request, client, server):
         BaseHTTPServer.BaseHTTPRequestHandler.__init__(self,
                 request, client, server)
         self.docroot = server.docroot
 
+    def setup(self):
+        if self.timeout is None:
+            self.timeout = config.SOCKET_TIMEOUT/1000.0
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
     def do_GET(self):
-        f = self.send_head()
+        # (prefix, offset, length) of the parts of a partial response
+        self.parts = None
+        self.trailer = ""
+        self.send_body(self.send_head())
+
+    def send_body(self, f):
+        """sends the body f returned by send_head, if there is one"""
         if f:
             # one minute
 #            self.connection.settimeout(60)
 #            shutil.copyfileobj(f, self.wfile)
-            sendfile.sendfile(self.request, f)
+            if self.parts is None:
+                sendfile.sendfile(self.request, f)
+            else:
+                for prefix, offset, length in self.parts:
+                    self.wfile.write(prefix)
+                    f.seek(offset)
+                    sendfile.sendfile(self.request, f, length)
+                self.wfile.write(self.trailer)
             f.close()
-        else:
-            self.wfile.close()
 
     def send_head(self):
-        self.path = self.path.split("?")[0]
+        self.path, query = (self.path.split("?", 1) + [""])[:2]
+        self.query = cgi.parse_qs(query)
+        if self.path == "/__search__":
+            self.send_search(self.query)
+            return None
         path = self.translate_path(self.path)
         if os.path.isdir(path):
             return self.list_directory(path)
@@ -202,35 +1487,191 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def send_file(self, path):
         ctype = self.guess_type(path)
-        try:
-            f = open(path, 'rb')
-        except IOError:
-            self.send_error(404, "File not found")
-            return None
-        fs = os.fstat(f.fileno())
-        size = fs[6]
-        # very very limited support for the range header
-        # print self.headers["Range"]
-        if "Range" in self.headers and self.headers["Range"].endswith("-"):
-            try:
-                crange = int(self.headers["Range"][6:-1])
-                f.seek(crange)
-                self.send_response(206)
-                self.send_header("Content-Range",
-                        "bytes %i-%i/%i" % (crange, size, size))
-                size -= crange
-            except ValueError:
-                self.send_response(200)
+        # the small files of the web interface are sent from memory
+        static = path.startswith(config.DATA_PATH) and \
+                self.server.static.get(path)
+        if static:
+            fs, data, encoded = static
+            f = StringIO(data)
         else:
+            try:
+                f = open(path, 'rb')
+            except IOError:
+                self.send_error(404, "File not found")
+                return None
+            fs = os.fstat(f.fileno())
+        size = fs.st_size
+        mtime = self.date_time_string(fs.st_mtime)
+        etag = '"%x-%x-%x"' % (fs.st_ino, size, int(fs.st_mtime * 1000000))
+        # only the static files of the web interface get compressed,
+        # the shared ones are mostly compressed already
+        compressible = static and size >= self.compress_size and \
+                self.compressible.match(ctype)
+        encoding = None
+        if compressible and "Range" not in self.headers:
+            encoding = self.accepted_encoding()
+        if encoding:
+            if encoding not in encoded:
+                encoded[encoding] = compress(data, encoding)
+            f = StringIO(encoded[encoding])
+            size = len(encoded[encoding])
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        if self.not_modified(etag, fs.st_mtime):
+            f.close()
+            self.send_not_modified(etag, mtime)
+            return None
+        ranges = None
+        if "Range" in self.headers and \
+                self.headers.get("If-Range", etag) in (etag, mtime):
+            ranges = parse_ranges(self.headers["Range"], size)
+        if ranges == []:
+            f.close()
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%i" % size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        if not ranges:
             self.send_response(200)
-        self.send_header("Content-Type", ctype)
+            self.send_header("Content-Type", ctype)
+            if encoding:
+                self.send_header("Content-Encoding", encoding)
+        elif len(ranges) == 1:
+            first, last = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Range",
+                    "bytes %i-%i/%i" % (first, last, size))
+            self.parts = [("", first, last - first + 1)]
+            size = last - first + 1
+        else:
+            boundary = "%016x" % random.getrandbits(64)
+            self.parts = [("\r\n--%s\r\nContent-Type: %s\r\n"
+                "Content-Range: bytes %i-%i/%i\r\n\r\n" %
+                (boundary, ctype, first, last, size), first, last - first + 1)
+                for first, last in ranges]
+            self.trailer = "\r\n--%s--\r\n" % boundary
+            self.send_response(206)
+            self.send_header("Content-Type",
+                    "multipart/byteranges; boundary=" + boundary)
+            size = sum(len(prefix) + length
+                    for prefix, offset, length in self.parts)
+            size += len(self.trailer)
         self.send_header("Content-Length", str(size))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
-        # dont show this header until its __fully__ implemented
-        #self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", mtime)
+        self.send_header("ETag", etag)
+        self.send_header("Accept-Ranges", "bytes")
+        if compressible:
+            self.send_header("Vary", "Accept-Encoding")
+        if path.startswith(config.DATA_PATH):
+            # versioned urls change with the file
+            if "v" in self.query:
+                self.send_header("Cache-Control",
+                        "public, max-age=31536000, immutable")
+            else:
+                self.send_header("Cache-Control",
+                        "public, max-age=%i" % self.data_max_age)
         self.end_headers()
         return f
 
+    def accepted_encoding(self):
+        """
+        returns the content coding to compress the response with,
+        gzip or deflate, or None if the client accepts neither
+        """
+        accepted = {}
+        for coding in self.headers.get("Accept-Encoding", "").split(","):
+            params = coding.split(";")
+            quality = 1.0
+            for param in params[1:]:
+                name, _, value = param.partition("=")
+                if name.strip() == "q":
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            accepted[params[0].strip().lower()] = quality
+        for encoding in ("gzip", "deflate"):
+            if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+                return encoding
+        return None
+
+    def not_modified(self, etag, mtime=None):
+        """
+        returns True if the If-None-Match or, lacking it, the
+        If-Modified-Since header of the request validate etag or mtime
+        """
+        if "If-None-Match" in self.headers:
+            tags = [tag.strip() for tag in
+                    self.headers["If-None-Match"].split(",")]
+            return "*" in tags or etag in tags or "W/" + etag in tags
+        if mtime is not None and "If-Modified-Since" in self.headers:
+            since = email.utils.parsedate_tz(self.headers["If-Modified-Since"])
+            return since is not None and \
+                    int(mtime) <= email.utils.mktime_tz(since)
+        return False
+
+    def send_not_modified(self, etag, mtime=None):
+        """answer with 304 Not Modified"""
+        self.send_response(304)
+        self.send_header("ETag", etag)
+        if mtime:
+            self.send_header("Last-Modified", mtime)
+        self.end_headers()
+
+    def send_search(self, query):
+        """
+        streams the results of the search ?q=regex&from=offset as chunked
+        json lines of [path, size, mtime], followed by {"next": offset}
+        if there are more
+        """
+        fileindex = self.server.fileindex
+        if not fileindex:
+            self.send_error(404, "File not found")
+            return
+        try:
+            what = query.get("q", [""])[0].decode("utf-8")
+            offset = int(query.get("from", ["0"])[0])
+            search = compile_search(what)
+        except (UnicodeError, ValueError, re.error):
+            self.send_error(400, "Invalid search")
+            return
+        if offset < 0 or \
+                classify(search.pattern, search.flags) == PATHOLOGICAL:
+            self.send_error(400, "Invalid search")
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        if self.request_version != "HTTP/1.0":
+            self.send_header("Transfer-Encoding", "chunked")
+        else:
+            # the results end with the connection
+            self.send_header("Connection", "close")
+        self.end_headers()
+        end = offset + config.MAX_SEARCH_RESULTS
+        found = 0
+        # one more to know whether there is another page
+        for result in fileindex.iterate(search, end + 1):
+            if found == end:
+                self.send_chunk(simplejson.dumps({"next": end}) + "\n")
+                break
+            if found >= offset:
+                path, size, mtime = result
+                result = (path[len(fileindex.path):], size, mtime)
+                self.send_chunk(simplejson.dumps(result) + "\n")
+            found += 1
+        self.send_chunk("")
+
+    def send_chunk(self, data):
+        """
+        writes data as a chunk of a chunked response, HTTP/1.0 clients
+        get it as it is
+        """
+        if self.request_version == "HTTP/1.0":
+            self.wfile.write(data)
+        else:
+            self.wfile.write("%x\r\n%s\r\n" % (len(data), data))
+
     def guess_type(self, path):
         if path.endswith("/"):
             return "text/html"
@@ -254,91 +1695,256 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def list_directory(self, path):
         """create a directory listing"""
-        self.send_response(200)
+        if "Accept" in self.headers and not "json" in self.headers["Accept"]:
+            ctype = "application/xhtml+xml; charset=utf-8"
+        else:
+            ctype = "application/json"
         try:
-            files = []
-            for filename in os.listdir(path):
-                if hidden(filename):
-                    continue
-                filepath = os.path.join(path, filename)
-                try:
-                    stats = os.stat(filepath)
-                    if stat.S_ISDIR(stats[stat.ST_MODE]):
-                        filename += '/'
-                        dirfiles = os.listdir(filepath)
-                        def dir_only(name):
-                            return os.path.isdir(os.path.join(filepath, name))
-                        dirs = filter(dir_only, dirfiles)
-                        size = (len(dirs), len(dirfiles)-len(dirs))
-                        icon = self.get_folder_image(filepath, dirfiles)
-                    else:
-                        size = stats[stat.ST_SIZE]
-                        icon = None
-                    try:
-                        filename = filename.decode(config.FS_ENCODING)
-                        if icon:
-                            icon = icon.decode(config.FS_ENCODING)
-                        files.append((filename, size, icon))
-                    except UnicodeError, e:
-                        if config.debug:
-                            logger.exception("Could not decode filename %r "
-                                    "maybe %r is the wrong FS_ENCODING",
-                                    filename, config.FS_ENCODING)
-                except os.error, e:
-                    logger.debug(e)
-        except os.error, e:
-            logger.exception("Exception while listing %s", path)
-            self.send_error(404, "File not found")
+            name, sort, offset, limit = self.listing_query()
+        except ValueError:
+            self.send_error(400, "Invalid listing")
             return None
-        if "Accept" in self.headers and not "json" in self.headers["Accept"]:
-            f = self.list_directory_html(files)
+        # the html listing links to self.path, lookups of single entries
+        # are cheap and would just push the listings out of the cache
+        if name is None:
+            key = (path, ctype, self.path, sort, offset, limit)
+            listing = self.server.listings.get(key)
         else:
-            f = self.list_directory_json(files)
-        length = f.tell()
-        self.send_header("Content-length", str(length))
+            key = listing = None
+        if listing is None:
+            dirs = []
+            try:
+                count, files = self.read_directory(path, dirs, name)
+            except os.error, e:
+                logger.exception("Exception while listing %s", path)
+                self.send_error(404, "File not found")
+                return None
+            if sort != "name":
+                files = list(files)
+                sortkey = self.sort_keys[sort.lstrip("-")]
+                if sortkey:
+                    files.sort(key=sortkey, reverse=sort[0] == "-")
+                else:
+                    files.reverse()
+            count = max(count - offset, 0)
+            if limit is not None:
+                count = min(count, limit)
+                limit += offset
+            files = itertools.islice(files, offset, limit)
+            # the mtime is only used for sorting
+            files = (entry[:3] for entry in files)
+            if ctype == "application/json":
+                pieces = self.list_directory_json(files)
+            else:
+                pieces = self.list_directory_html(files)
+            if count > self.stream_entries and \
+                    self.request_version != "HTTP/1.0":
+                self.stream_listing(key, ctype, dirs, pieces)
+                return None
+            body = "".join(pieces)
+            # the listing changes with the contents of the directory
+            listing = self.make_listing(body)
+            if key:
+                self.server.listings.put(key, dirs, listing)
+        body, etag, encoded = listing
+        encoding = len(body) >= self.compress_size and self.accepted_encoding()
+        if encoding:
+            # compressed once for all the requests hitting the cache
+            if encoding not in encoded:
+                encoded[encoding] = compress(body, encoding)
+            body = encoded[encoding]
+            etag = '%s-%s"' % (etag[:-1], encoding)
+        if self.not_modified(etag):
+            self.send_not_modified(etag)
+            return None
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Content-length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("ETag", etag)
+        self.send_header("Vary", "Accept, Accept-Encoding")
         self.end_headers()
-        f.seek(0)
-        return f
+        return StringIO(body)
+
+    def make_listing(self, body):
+        """
+        returns the cached form of the listing body, (body, etag, dict of
+        the compressed bodies by content coding)
+        """
+        return (body, '"%s"' % hashlib.md5(body).hexdigest(), {})
+
+    def stream_listing(self, key, ctype, dirs, pieces):
+        """
+        sends the pieces of a listing as chunks while they are being
+        made and caches the whole listing afterwards
+        """
+        encoding = self.accepted_encoding()
+        compressobj = encoding and compressor(encoding)
+        self.send_response(200)
+        self.send_header("Content-type", ctype)
+        self.send_header("Transfer-Encoding", "chunked")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Vary", "Accept, Accept-Encoding")
+        self.end_headers()
+        # the pieces sent so far, None if they can't be cached anyway
+        sent = [] if self.server.listings.size else None
+        buffered = []
+        size = 0
+        flushed = time.time()
+        for piece in pieces:
+            buffered.append(piece)
+            size += len(piece)
+            # no chunk for every entry but no waiting for slow ones either
+            if size >= 16384 or time.time() - flushed > 0.1:
+                self.flush_listing(buffered, sent, compressobj)
+                size = 0
+                flushed = time.time()
+        self.flush_listing(buffered, sent, compressobj)
+        if compressobj:
+            self.send_chunk(compressobj.flush())
+        self.send_chunk("")
+        if sent is not None:
+            self.server.listings.put(key, dirs,
+                    self.make_listing("".join(sent)))
+
+    def flush_listing(self, buffered, sent, compressobj=None):
+        """sends the buffered pieces of a listing as a chunk"""
+        data = "".join(buffered)
+        del buffered[:]
+        if data:
+            if sent is not None:
+                sent.append(data)
+            if compressobj:
+                # the client can decompress everything sent so far
+                data = compressobj.compress(data) + \
+                        compressobj.flush(zlib.Z_SYNC_FLUSH)
+            self.send_chunk(data)
+
+    def listing_query(self):
+        """
+        returns the (name, sort, offset, limit) asked for by the query of
+        a listing request, name is the only entry to list, sort one of
+        sort_keys, prefixed by a - for descending order. raises a
+        ValueError if any of them is invalid
+        """
+        name = self.query.get("name", [None])[0]
+        if name is not None:
+            name = name.decode("utf-8").encode(config.FS_ENCODING).rstrip("/")
+            if not name or "/" in name or name in (os.curdir, os.pardir):
+                raise ValueError(name)
+        sort = self.query.get("sort", ["name"])[0]
+        if sort.lstrip("-") not in self.sort_keys:
+            raise ValueError(sort)
+        offset = int(self.query.get("offset", ["0"])[0])
+        limit = None
+        if "limit" in self.query:
+            limit = int(self.query["limit"][0])
+        if offset < 0 or (limit is not None and limit < 0):
+            raise ValueError(offset, limit)
+        return name, sort, offset, limit
+
+    def read_directory(self, path, dirs, name=None):
+        """
+        returns the number of entries of path and a generator of the
+        (filename, size, icon, mtime) of the visible ones in order of
+        their names, only of the one called name if it is given. The
+        (path, stat key) of the directories they are read from are
+        added to dirs
+        """
+        dirs.append((path, dirstat(path)))
+        if name is None:
+            entries = sorted(dirent.listdir(path))
+        else:
+            entries = [(name, dirent.DT_UNKNOWN)]
+        return len(entries), self.read_entries(path, entries, dirs)
+
+    def read_entries(self, path, entries, dirs):
+        """yields the (filename, size, icon, mtime) of the visible entries"""
+        for filename, type in entries:
+            if hidden(filename):
+                continue
+            filepath = os.path.join(path, filename)
+            try:
+                # only files need to be stated for their size
+                if dirent.isdir(filepath, type):
+                    filename += '/'
+                    stats = dirstat(filepath)
+                    dirs.append((filepath, stats))
+                    mtime = stats[0]
+                    dirfiles = []
+                    visible = subdirs = 0
+                    for name, type in dirent.listdir(filepath):
+                        dirfiles.append(name)
+                        # counted like the file index counts for searches
+                        if hidden(name):
+                            continue
+                        visible += 1
+                        if dirent.isdir(os.path.join(filepath, name), type):
+                            subdirs += 1
+                    size = (subdirs, visible - subdirs)
+                    # folder images may be hidden files
+                    icon = self.get_folder_image(filepath, dirfiles)
+                else:
+                    stats = os.stat(filepath)
+                    size = stats.st_size
+                    mtime = stats.st_mtime
+                    icon = None
+                try:
+                    filename = filename.decode(config.FS_ENCODING)
+                    if icon:
+                        icon = icon.decode(config.FS_ENCODING)
+                except UnicodeError, e:
+                    if config.debug:
+                        logger.exception("Could not decode filename %r "
+                                "maybe %r is the wrong FS_ENCODING",
+                                filename, config.FS_ENCODING)
+                    continue
+            except os.error, e:
+                logger.debug(e)
+                continue
+            yield filename, size, icon, int(mtime)
 
     def list_directory_json(self, files):
-        """Ouput directorylisting as json"""
-        self.send_header("Content-type", "application/json")
-        f = StringIO()
-        simplejson.dump(files, f)
-        return f
+        """
+        Ouput directorylisting as json piece by piece, one entry per line
+        so clients can parse the entries as they arrive
+        """
+        yield "["
+        separator = "\n"
+        for entry in files:
+            yield separator + simplejson.dumps(entry)
+            separator = ",\n"
+        yield "\n]\n"
 
     def list_directory_html(self, files):
-        """Ouput directorylisting as html"""
+        """Ouput directorylisting as html piece by piece"""
         # template engine anybody?
-        files.sort()
-        f = StringIO()
-        self.send_header("Content-type", "application/xhtml+xml; charset=utf-8")
         if config.DISABLE_WEBINTERFACE:
-            return f
+            return
         displaypath = cgi.escape(urllib2.unquote(self.path))
-        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+        yield ('<?xml version="1.0" encoding="UTF-8"?>\n'
                 '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN"\n'
                 '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
                 '<html xmlns="http://www.w3.org/1999/xhtml">'
                 '<head>'
                 '<title>Index of %s</title>' % displaypath)
-        f.write('<link rel="stylesheet" type="text/css" '
-                'href="/__data__/directoryindex.css" />'
-                '<link rel="stylesheet" type="text/css" '
-                'href="/__data__/thickbox.css" />'
+        yield ('<link rel="stylesheet" type="text/css" href="%s" />'
+                '<link rel="stylesheet" type="text/css" href="%s" />'
                 #'<script type="text/javascript" '
                 #'src="/__data__/reflection.js"></script>'
-                '<script type="text/javascript" '
-                'src="/__data__/jquery.js"></script>'
-                '<script type="text/javascript" '
-                'src="/__data__/thickbox.js"></script>'
-                '</head><body><h1>')
+                '<script type="text/javascript" src="%s"></script>'
+                '<script type="text/javascript" src="%s"></script>'
+                '</head><body><h1>' % (data_url("directoryindex.css"),
+                    data_url("thickbox.css"), data_url("jquery.js"),
+                    data_url("thickbox.js")))
         paths = self.path.split("/")
         for i in xrange(self.path.count("/")):
-            f.write('<a href="%s/">%s/</a>' % ("/".join(paths[:i+1]),
+            yield ('<a href="%s/">%s/</a>' % ("/".join(paths[:i+1]),
                 cgi.escape(urllib2.unquote(paths[i]))))
-        f.write('</h1><div id="container">'
-                '<img src="/__data__/web/web_head.png" alt="" /><ul>')
+        yield ('</h1><div id="container">'
+                '<img src="%s" alt="" /><ul>' % data_url("web/web_head.png"))
         even = True
         for filename, size, icon in files:
             if filename.endswith("/"):
@@ -362,21 +1968,21 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 logger.debug("unable to convert filename %r to utf-8",
                         filename)
             else:
-                f.write('<li><a')
+                yield '<li><a'
                 if any(filename.endswith(ext)
                     for ext in [".jpg", ".jpeg", ".gif"]):
-                    f.write(' class="thickbox"')
-                f.write(' href="%s" title="%s">'
+                    yield ' class="thickbox"'
+                yield (' href="%s" title="%s">'
                         '<img src="%s" alt="" width="96" height="96"'
                         ' class="reflect rheight25 icon" />%s</a></li>' %
                         (href, ssize, icon, encfilename))
 
-        f.write('</ul>'#<a href="' + config.WEBSITE + '">'
+        yield ('</ul>'#<a href="' + config.WEBSITE + '">'
                 '<a href="http://lanshark.29a.ch/">'
-                '<img src="/__data__/web/web_footer.png" '
-                'alt="Lanshark Webinterface" class="clear reflect" /></a>')
-        f.write("</div><div></div></body></html>")
-        return f
+                '<img src="%s" alt="Lanshark Webinterface" '
+                'class="clear reflect" /></a>' %
+                data_url("web/web_footer.png"))
+        yield "</div><div></div></body></html>"
 
     def translate_path(self, path):
         path = urllib2.unquote(path).decode('utf-8').encode(config.FS_ENCODING)
@@ -397,34 +2003,458 @@ class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_message(self, format, *args):
         logger.info(format % args)
 
-class HTTPService(threading.Thread, SocketServer.ThreadingMixIn,
-        SocketServer.TCPServer):
-    """Some wrapper arround SocketServer"""
+class HTTPService(threading.Thread, SocketServer.TCPServer):
+    """
+    Some wrapper arround SocketServer. The connections are served by a
+    pool of HTTP_THREADS threads, up to HTTP_QUEUE of them wait for a
+    free thread, further ones are turned away with 503 Service Unavailable
+    """
     allow_reuse_address = True
     logRequests = config.debug
     protocol_version = "HTTP/1.1"
-    daemon_threads = True
-    def __init__(self, docroot):
+    # seconds rejected clients are asked to wait before retrying
+    retry_after = 10
+    def __init__(self, docroot, fileindex=None, port=None):
         threading.Thread.__init__(self)
+        if port is None:
+            port = config.PORT
         SocketServer.TCPServer.__init__(self,
-                ("", config.PORT), HTTPRequestHandler)
+                ("", port), HTTPRequestHandler)
         self.setDaemon(True)
         self.docroot = docroot
+        # answers /__search__, None if searches are not answered at all
+        self.fileindex = fileindex
+        self.listings = ListingCache(config.LISTING_CACHE)
+        self.static = StaticFiles()
+        self.threads = config.HTTP_THREADS
+        # Queue.Queue(0) would never be full
+        self.queue = Queue.Queue(max(config.HTTP_QUEUE, 1))
+        self.rejected = 0
+        self.workers = []
+
+    def process_request(self, request, client):
+        """queues the connection for the next free thread"""
+        try:
+            self.queue.put_nowait((request, client))
+        except Queue.Full:
+            self.rejected += 1
+            self.reject(request)
+
+    def reject(self, request):
+        """answers request with 503 Service Unavailable and closes it"""
+        request.setblocking(0)
+        try:
+            # unread requests would turn the close into a reset
+            request.recv(65536)
+        except socket.error:
+            pass
+        try:
+            request.send("HTTP/1.1 503 Service Unavailable\r\n"
+                    "Retry-After: %i\r\n"
+                    "Content-Length: 0\r\n"
+                    "Connection: close\r\n\r\n" % self.retry_after)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def work(self):
+        """serves the queued connections"""
+        while True:
+            item = self.queue.get()
+            # put by stop
+            if item is None:
+                return
+            request, client = item
+            try:
+                self.finish_request(request, client)
+            except Exception:
+                self.handle_error(request, client)
+            self.shutdown_request(request)
 
     def handle_error(self, request, client):
         logger.exception("Exception occured while serving request "
                 "for client %s", client)
 
     def run(self):
+        for i in xrange(self.threads):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
         self.serve_forever()
 
+    def stop(self):
+        """
+        stops accepting connections, waits for the workers to finish the
+        ones already accepted and closes the socket
+        """
+        if self.workers:
+            self.shutdown()
+            for worker in self.workers:
+                self.queue.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+        self.server_close()
+
+class EventHTTPRequestHandler(HTTPRequestHandler):
+    """
+    Handles a single request read by the EventHTTPService. The response
+    head goes to memory, its body is left to the event loop. Chunked
+    responses are passed to the loop chunk by chunk as they are made
+    """
+    def setup(self):
+        head, self.client = self.request
+        self.rfile = StringIO(head)
+        self.wfile = StringIO()
+        self.body = None
+        self.parts = None
+        self.trailer = ""
+
+    def handle(self):
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+    def send_body(self, f):
+        self.body = f
+
+    def send_chunk(self, data):
+        HTTPRequestHandler.send_chunk(self, data)
+        self.server.stream(self.client, self.wfile.getvalue())
+        self.wfile = StringIO()
+
+class Connection(object):
+    """A client connection of the EventHTTPService"""
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.fd = sock.fileno()
+        self.address = address
+        self.mask = 0
+        # the data received but not handled yet
+        self.input = ""
+        # the response head and the offset of the data not sent yet
+        self.output = ""
+        self.sent = 0
+        # the file the body is sent from and the remaining
+        # (prefix, offset, length) parts of it
+        self.body = None
+        self.parts = []
+        self.close = False
+        self.handling = False
+        self.closed = False
+        self.active = time.time()
+
+class EventHTTPService(threading.Thread):
+    """
+    Serves http from an event loop using epoll or poll. The loop reads
+    the requests and sends the responses, files using sendfile, so idle
+    keep-alive connections and downloads don't need a thread each.
+    The requests themselves are handled by HTTP_THREADS worker threads
+    using the EventHTTPRequestHandler
+    """
+    available = hasattr(select, "epoll") or hasattr(select, "poll")
+    # seconds a keep-alive connection may wait for its next request
+    idle_timeout = 120
+    max_head = 65536
+    head_end = re.compile(r"\r?\n\r?\n")
+
+    def __init__(self, docroot, fileindex=None, port=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.docroot = docroot
+        # answers /__search__, None if searches are not answered at all
+        self.fileindex = fileindex
+        self.listings = ListingCache(config.LISTING_CACHE)
+        self.static = StaticFiles()
+        if port is None:
+            port = config.PORT
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("", port))
+        self.socket.listen(128)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.timescale = 1
+        else:
+            self.poller = select.poll()
+            self.timescale = 1000
+        # fd -> Connection
+        self.connections = {}
+        self.requests = Queue.Queue()
+        self.responses = Queue.Queue()
+        # the workers wake up the loop by writing to this pipe
+        self.wakeup = os.pipe()
+        self.workers = []
+        self.stopping = False
+        # set once the loop has returned
+        self.stopped = threading.Event()
+
+    def run(self):
+        for i in xrange(config.HTTP_THREADS):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+        self.poller.register(self.socket.fileno(), select.POLLIN)
+        self.poller.register(self.wakeup[0], select.POLLIN)
+        try:
+            self.loop()
+        finally:
+            self.stopped.set()
+
+    def loop(self):
+        """waits for and handles events until stop is called"""
+        expired = time.time()
+        while not self.stopping:
+            try:
+                events = self.poller.poll(self.timescale)
+            except (IOError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, mask in events:
+                if fd == self.socket.fileno():
+                    self.accept()
+                elif fd == self.wakeup[0]:
+                    os.read(fd, 4096)
+                    self.respond()
+                elif fd in self.connections:
+                    self.process(self.connections[fd], mask)
+            if time.time() - expired > 1:
+                self.expire()
+                expired = time.time()
+
+    def work(self):
+        """handles the requests read by the event loop"""
+        while True:
+            item = self.requests.get()
+            # put by stop
+            if item is None:
+                return
+            connection, head = item
+            try:
+                handler = EventHTTPRequestHandler((head, connection),
+                        connection.address, self)
+                response = (handler.wfile.getvalue(), handler.body,
+                        handler.parts, handler.trailer,
+                        handler.close_connection, True)
+            except Exception:
+                logger.exception("Exception occured while serving request "
+                        "for client %s", connection.address)
+                response = ("", None, None, "", True, True)
+            self.responses.put((connection, response))
+            os.write(self.wakeup[1], "!")
+
+    def stream(self, connection, output):
+        """
+        passes the start of a response to the loop while the rest of it
+        is still being handled
+        """
+        self.responses.put((connection, (output, None, None, "", False,
+            False)))
+        os.write(self.wakeup[1], "!")
+
+    def stop(self):
+        """
+        stops the event loop and the workers, closes all the connections
+        and the listening socket
+        """
+        if self.workers:
+            self.stopping = True
+            os.write(self.wakeup[1], "!")
+            self.stopped.wait()
+            for worker in self.workers:
+                self.requests.put(None)
+            for worker in self.workers:
+                worker.join()
+            self.workers = []
+        for connection in self.connections.values():
+            self.close(connection)
+        if hasattr(self.poller, "close"):
+            self.poller.close()
+        self.socket.close()
+        os.close(self.wakeup[0])
+        os.close(self.wakeup[1])
+
+    def watch(self, connection, mask):
+        """changes the events the loop waits for on connection"""
+        if connection.mask != mask:
+            self.poller.modify(connection.fd, mask)
+            connection.mask = mask
+
+    def accept(self):
+        """accepts all the pending connections"""
+        while True:
+            try:
+                sock, address = self.socket.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EINTR, errno.ECONNABORTED):
+                    continue
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    logger.error("Could not accept connection: %s", e)
+                return
+            sock.setblocking(0)
+            connection = Connection(sock, address)
+            self.connections[connection.fd] = connection
+            self.poller.register(connection.fd, select.POLLIN)
+            connection.mask = select.POLLIN
+
+    def process(self, connection, mask):
+        """handles the events of connection"""
+        connection.active = time.time()
+        if mask & select.POLLIN:
+            self.read(connection)
+        elif mask & select.POLLOUT:
+            self.write(connection)
+        elif mask & (select.POLLERR | select.POLLHUP):
+            self.close(connection)
+
+    def read(self, connection):
+        """receives the next request of connection"""
+        try:
+            data = connection.socket.recv(65536)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK,
+                    errno.EINTR):
+                self.close(connection)
+            return
+        if not data:
+            self.close(connection)
+            return
+        connection.input += data
+        self.dispatch(connection)
+
+    def dispatch(self, connection):
+        """passes the next complete request of connection to the workers"""
+        # there might be empty lines between pipelined requests
+        connection.input = connection.input.lstrip("\r\n")
+        end = self.head_end.search(connection.input)
+        if not end:
+            if len(connection.input) > self.max_head:
+                self.close(connection)
+            return
+        head = connection.input[:end.end()]
+        connection.input = connection.input[end.end():]
+        connection.handling = True
+        # only errors until the response is ready
+        self.watch(connection, 0)
+        self.requests.put((connection, head))
+
+    def respond(self):
+        """starts sending the responses handled by the workers"""
+        while True:
+            try:
+                connection, response = self.responses.get_nowait()
+            except Queue.Empty:
+                return
+            output, body, parts, trailer, close, done = response
+            if connection.closed:
+                if body:
+                    body.close()
+                continue
+            # the streamed start of the response might not be sent yet
+            connection.output = connection.output[connection.sent:] + output
+            connection.sent = 0
+            connection.active = time.time()
+            if not done:
+                self.write(connection)
+                continue
+            connection.handling = False
+            connection.close = close
+            if body:
+                if parts is None:
+                    offset = body.tell()
+                    body.seek(0, 2)
+                    parts = [("", offset, body.tell() - offset)]
+                connection.body = body
+                connection.parts = list(parts)
+                if trailer:
+                    connection.parts.append((trailer, 0, 0))
+            self.write(connection)
+
+    def write(self, connection):
+        """sends as much of the response of connection as possible"""
+        sock = connection.socket
+        parts = connection.parts
+        try:
+            while True:
+                if connection.sent < len(connection.output):
+                    connection.sent += sock.send(connection.output[
+                        connection.sent:connection.sent + 65536])
+                elif parts and parts[0][0]:
+                    connection.output = parts[0][0]
+                    connection.sent = 0
+                    parts[0] = ("",) + parts[0][1:]
+                elif parts and parts[0][2]:
+                    prefix, offset, length = parts[0]
+                    sent = sendfile.sendsome(sock, connection.body, offset,
+                            length)
+                    if not sent:
+                        # the file got shorter
+                        self.close(connection)
+                        return
+                    parts[0] = ("", offset + sent, length - sent)
+                elif parts:
+                    parts.pop(0)
+                else:
+                    break
+        except (socket.error, OSError), e:
+            if getattr(e, "errno", None) in (errno.EAGAIN, errno.EWOULDBLOCK,
+                    errno.EINTR):
+                self.watch(connection, select.POLLOUT)
+            else:
+                self.close(connection)
+            return
+        connection.output = ""
+        connection.sent = 0
+        if connection.handling:
+            # the rest of a streamed response is still being made
+            self.watch(connection, 0)
+            return
+        if connection.body:
+            connection.body.close()
+            connection.body = None
+        if connection.close:
+            self.close(connection)
+            return
+        self.watch(connection, select.POLLIN)
+        self.dispatch(connection)
+
+    def close(self, connection):
+        """closes connection, a response being handled gets dropped"""
+        if connection.closed:
+            return
+        connection.closed = True
+        del self.connections[connection.fd]
+        self.poller.unregister(connection.fd)
+        connection.socket.close()
+        if connection.body:
+            connection.body.close()
+            connection.body = None
+
+    def expire(self):
+        """closes the connections which have been idle for too long"""
+        timeout = time.time() - self.idle_timeout
+        for connection in self.connections.values():
+            if not connection.handling and connection.active < timeout:
+                self.close(connection)
+
 class Daemon:
     """The container for the lanshark http, udp and fileindex service"""
     def __init__(self):
-        self.httpservice = HTTPService(config.SHARE_PATH)
+        self.fileindex = None
         if not config.INVISIBLE:
             self.fileindex = FileIndex(config.SHARE_PATH)
             self.udpservice = UDPService(self.fileindex)
+        if config.HTTP_EVENT_LOOP and EventHTTPService.available:
+            self.httpservice = EventHTTPService(config.SHARE_PATH,
+                    self.fileindex)
+        else:
+            self.httpservice = HTTPService(config.SHARE_PATH, self.fileindex)
         config.connect("SHARE_PATH", self.share_path_changed)
 
     def share_path_changed(self):
@@ -448,5 +2478,9 @@ class Daemon:
         self.udpservice.start()
         self.httpservice.run()
 
+    def stop(self):
+        """stops the http service"""
+        self.httpservice.stop()
+
 if __name__ == "__main__":
     Daemon().run()
@@ -0,0 +1,112 @@
+#!/usr/bin/python
+"""A Python wrapper arround the readdir64() libc call which also returns
+the type of the directory entries so they don't need to be stat()ed.
+Falls back to os.listdir in case readdir64 is not avaible"""
+import os
+import sys
+
+DT_UNKNOWN = 0
+DT_DIR = 4
+DT_REG = 8
+DT_LNK = 10
+
+def _listdir(path):
+    """
+    returns the entries of path as (filename, type) tuples, the type
+    is one of the DT_ constants or DT_UNKNOWN if it's not known
+    """
+    return [(filename, DT_UNKNOWN) for filename in os.listdir(path)]
+
+if sys.platform == "linux2":
+    import ctypes as c
+    class dirent64(c.Structure):
+        _fields_ = [("d_ino", c.c_uint64), ("d_off", c.c_int64),
+                ("d_reclen", c.c_ushort), ("d_type", c.c_ubyte),
+                ("d_name", c.c_char * 256)]
+    try:
+        libc = c.cdll.LoadLibrary('libc.so.6')
+        libc.__errno_location.restype = c.POINTER(c.c_int)
+        opendir = libc.opendir
+        opendir.argtypes = [c.c_char_p]
+        opendir.restype = c.c_void_p
+        readdir64 = libc.readdir64
+        readdir64.argtypes = [c.c_void_p]
+        readdir64.restype = c.POINTER(dirent64)
+        closedir = libc.closedir
+        closedir.argtypes = [c.c_void_p]
+        closedir.restype = c.c_int
+    except (OSError, AttributeError), e:
+        listdir = _listdir
+    else:
+        def listdir(path):
+            if isinstance(path, unicode):
+                return _listdir(path)
+            errno = libc.__errno_location().contents
+            dir = opendir(path)
+            if not dir:
+                raise OSError(errno.value, os.strerror(errno.value), path)
+            try:
+                entries = []
+                while True:
+                    errno.value = 0
+                    entry = readdir64(dir)
+                    if not entry:
+                        if errno.value:
+                            raise OSError(errno.value,
+                                    os.strerror(errno.value), path)
+                        return entries
+                    entry = entry.contents
+                    filename = entry.d_name
+                    if filename != "." and filename != "..":
+                        entries.append((filename, entry.d_type))
+            finally:
+                closedir(dir)
+else:
+    listdir = _listdir
+
+def isdir(path, type):
+    """
+    returns True if path is a directory, only stats path if its type
+    is unknown or a symlink which has to be followed
+    """
+    if type == DT_DIR:
+        return True
+    if type == DT_UNKNOWN or type == DT_LNK:
+        return os.path.isdir(path)
+    return False
+
+def test():
+    import tempfile
+    if listdir == _listdir:
+        to_test = (listdir, )
+    else:
+        to_test = (listdir, _listdir)
+    path = tempfile.mkdtemp()
+    try:
+        os.mkdir(os.path.join(path, "foo"))
+        open(os.path.join(path, "bar"), "w").close()
+        os.symlink("foo", os.path.join(path, "link"))
+        for implementation in to_test:
+            if _listdir == implementation:
+                print "using python implementation"
+            else:
+                print "using native readdir"
+            entries = sorted(implementation(path))
+            assert [entry[0] for entry in entries] == ["bar", "foo", "link"]
+            assert [isdir(os.path.join(path, filename), type)
+                    for filename, type in entries] == [False, True, True]
+            try:
+                implementation(os.path.join(path, "missing"))
+            except OSError, e:
+                assert e.errno == 2
+            else:
+                assert False
+    finally:
+        os.remove(os.path.join(path, "link"))
+        os.remove(os.path.join(path, "bar"))
+        os.rmdir(os.path.join(path, "foo"))
+        os.rmdir(path)
+    print "done"
+
+if __name__ == "__main__":
+    test()
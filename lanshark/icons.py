@@ -55,14 +55,21 @@ class IconFactory:
         pass
 
 class URLIconFactory(IconFactory):
-    """The URLIconFactory returns a url to the icon"""
-    def __init__(self, documentroot, urlroot, ext=".png"):
+    """
+    The URLIconFactory returns a url to the icon, versioned urls carry the
+    mtime of the icon so they can be cached forever
+    """
+    def __init__(self, documentroot, urlroot, ext=".png", versioned=False):
         self.documentroot = documentroot
         self.urlroot = urlroot
         self.ext = ext
+        self.versioned = versioned
 
     def get_icon(self, name):
         path = os.path.join(self.documentroot, name) + self.ext
         if os.path.exists(path):
-            return self.urlroot + name + self.ext
+            url = self.urlroot + name + self.ext
+            if self.versioned:
+                url += "?v=%x" % int(os.path.getmtime(path))
+            return url
         return None
@@ -0,0 +1,109 @@
+#!/usr/bin/python
+"""A Python wrapper arround the linux inotify syscalls.
+available is False on systems without inotify"""
+import os
+import struct
+import sys
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+available = False
+
+if sys.platform == "linux2":
+    import ctypes as c
+    try:
+        libc = c.cdll.LoadLibrary('libc.so.6')
+        libc.__errno_location.restype = c.POINTER(c.c_int)
+        def errnocheck(result, func, args):
+            if result < 0:
+                errno = libc.__errno_location().contents.value
+                raise OSError(errno, os.strerror(errno))
+            return result
+        inotify_init = libc.inotify_init
+        inotify_init.argtypes = []
+        inotify_init.errcheck = errnocheck
+        inotify_add_watch = libc.inotify_add_watch
+        inotify_add_watch.argtypes = [c.c_int, c.c_char_p, c.c_uint32]
+        inotify_add_watch.errcheck = errnocheck
+        inotify_rm_watch = libc.inotify_rm_watch
+        inotify_rm_watch.argtypes = [c.c_int, c.c_int]
+        inotify_rm_watch.errcheck = errnocheck
+    except (OSError, AttributeError), e:
+        pass
+    else:
+        available = True
+
+class Inotify:
+    """An inotify instance"""
+    event = struct.Struct("iIII")
+
+    def __init__(self):
+        self.fd = inotify_init()
+
+    def add_watch(self, path, mask):
+        """watch path for the events in mask, returns the watch descriptor"""
+        return inotify_add_watch(self.fd, path, mask)
+
+    def rm_watch(self, wd):
+        """stop watching the watch descriptor wd"""
+        inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        """
+        blocks until events are available and returns them as a list
+        of (wd, mask, cookie, name) tuples
+        """
+        data = os.read(self.fd, 65536)
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self.event.unpack_from(data, offset)
+            offset += self.event.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def test():
+    import tempfile
+    if not available:
+        print "inotify is not available"
+        return
+    path = tempfile.mkdtemp()
+    watcher = Inotify()
+    try:
+        wd = watcher.add_watch(path, IN_CREATE | IN_DELETE | IN_MOVED_FROM |
+                IN_MOVED_TO)
+        os.mkdir(os.path.join(path, "foo"))
+        os.rename(os.path.join(path, "foo"), os.path.join(path, "bar"))
+        os.rmdir(os.path.join(path, "bar"))
+        events = []
+        while len(events) < 4:
+            events += watcher.read()
+        assert [event[0] for event in events] == [wd] * 4
+        assert [event[1] for event in events] == [IN_CREATE | IN_ISDIR,
+                IN_MOVED_FROM | IN_ISDIR, IN_MOVED_TO | IN_ISDIR,
+                IN_DELETE | IN_ISDIR]
+        assert [event[3] for event in events] == ["foo", "foo", "bar", "bar"]
+        assert events[1][2] == events[2][2]
+        watcher.rm_watch(wd)
+    finally:
+        watcher.close()
+        os.rmdir(path)
+    print "done"
+
+if __name__ == "__main__":
+    test()
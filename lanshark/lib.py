@@ -23,10 +23,13 @@ import gc
 import logging
 import math
 import os
+import Queue
 import re
 import select, socket, subprocess, sys
+import threading
 import time
-import urllib2
+import urllib, urllib2
+import zlib
 
 import simplejson
 
@@ -82,7 +85,7 @@ def recv(sock, timeout, async):
             rwxlist = select.select((sock, ), (), (), maxwait)
             if rwxlist[0]:
                 try:
-                    data, addr = sock.recvfrom(1024)
+                    data, addr = sock.recvfrom(65536)
                     logger.debug("recv %r %r", addr, data)
                 except socket.error, e: # handle udp instability
                     logger.debug("socket.error in recv(): %r", e)
@@ -125,25 +128,152 @@ def discover(async=False):
         else:
             yield None
 
-def search(what, async=False):
-    """Search for files"""
+def search(what, async=False, more=None, stat=False):
+    """Search for files
+    Every peer sends at most MAX_SEARCH_RESULTS results. If more is a dict
+    the peers which have more results get stored in it for search_more,
+    otherwise the search stops after MAX_SEARCH_RESULTS results.
+    If stat is set (url, size, mtime) tuples are yielded instead of urls,
+    size is -1 and mtime None if the peer doesn't tell"""
+    peers = dict.fromkeys(config.STATICHOSTS, 0)
+    peers[None] = 0
+    return _search(what, peers, async, more, stat)
+
+def search_more(what, more, async=False, stat=False):
+    """Get the next results of a search for what from the peers which
+    search or search_more stored in more"""
+    peers = dict(more)
+    more.clear()
+    return _search(what, peers, async, more, stat)
+
+def _search(what, peers, async, more, stat):
+    """Search the peers for files starting at the offset they are mapped
+    to. Peers are None for the broadcast address, (addr, port) tuples
+    searched using udp or static "host:port" strings searched using http"""
     sock = network.broadcast_dgram_socket(config.CLIENT_PORT)
     what = what.encode('utf8')
-    msg = "search %s %s" % (config.NETWORK_NAME, what)
-    sock.sendto(msg, (config.BROADCAST_IP, config.PORT))
+    queries = {}
+    # results of all the peers, every thread searching puts None when done
+    found = Queue.Queue()
+    threads = []
+    for peer, offset in peers.iteritems():
+        if isinstance(peer, basestring):
+            threads.append(threading.Thread(target=_search_http,
+                    args=(peer, what, offset, found)))
+            continue
+        query = network.BATCH_SEARCH
+        if offset:
+            query += network.SEARCH_OFFSET % offset
+        query += what
+        queries[peer] = query
+        msg = "search %s %s" % (config.NETWORK_NAME, query)
+        sock.sendto(msg, peer or (config.BROADCAST_IP, config.PORT))
+    if queries:
+        threads.append(threading.Thread(target=_search_udp,
+                args=(sock, queries, peers, found)))
+    else:
+        sock.close()
+    for thread in threads:
+        thread.setDaemon(True)
+        thread.start()
+    searching = len(threads)
+    deadline = time.time() + config.SEARCH_TIMEOUT
     results = 0
-    for data in recv(sock, config.SEARCH_TIMEOUT, async):
-        if data:
-            msg, (addr, port) = data
-            if msg.startswith(what + ":"):
-                result = msg[len(what)+1:]
-                msg = urllib2.quote(result)
-                yield "http://%s:%i/%s" % (resolve(addr), port, msg)
-                results += 1
-                if results == config.MAX_SEARCH_RESULTS:
-                    return
+    while True:
+        timeout = deadline - time.time()
+        try:
+            if not searching or timeout <= 0:
+                peer, result = found.get_nowait()
+            elif async:
+                # a moment for the replies like recv gives them
+                peer, result = found.get(True, min(timeout, 0.001))
+            else:
+                peer, result = found.get(True, timeout)
+        except Queue.Empty:
+            if searching and time.time() < deadline:
+                if async:
+                    yield None
+                continue
+            # everything received in time has been yielded
+            return
+        if result is None:
+            searching -= 1
+        elif isinstance(result, int):
+            if more is not None:
+                more[peer] = result
         else:
-            yield None
+            yield stat and result or result[0]
+            results += 1
+            if more is None and results == config.MAX_SEARCH_RESULTS:
+                return
+
+def _search_udp(sock, queries, peers, found):
+    """Receive the replies to the udp queries for SEARCH_TIMEOUT, the
+    (url, size, mtime) of the results and the offsets of the next pages
+    go to the queue found like for _search_http"""
+    try:
+        for msg, (addr, port) in recv(sock, config.SEARCH_TIMEOUT, False):
+            query = queries.get((addr, port), queries.get(None))
+            if query is None or "%s:%i" % (addr, port) in peers:
+                continue
+            # batched replies separate the results by null bytes,
+            # older daemons send one result per datagram
+            if msg.startswith(query + "\0\0"):
+                offset = msg[len(query)+2:]
+                if offset.isdigit():
+                    found.put(((addr, port), int(offset)))
+                continue
+            elif msg.startswith(query + "\0"):
+                # path, size and mtime of every result
+                fields = msg[len(query)+1:].split("\0")
+                try:
+                    paths = [(fields[i], parse_size(fields[i+1]),
+                        int(fields[i+2])) for i in xrange(0, len(fields), 3)]
+                except (IndexError, ValueError):
+                    logger.debug("invalid search reply %r", msg)
+                    continue
+            elif msg.startswith(query + ":"):
+                paths = [(msg[len(query)+1:], -1, None)]
+            else:
+                continue
+            for path, size, mtime in paths:
+                url = "http://%s:%i/%s" % (resolve(addr), port,
+                        urllib2.quote(path))
+                found.put(((addr, port), (url, size, mtime)))
+    finally:
+        sock.close()
+        found.put((None, None))
+
+def parse_size(size):
+    """parses the size of a search result, directories have a size of
+    "subdirectories,files" which becomes a list like in listings"""
+    if "," in size:
+        return map(int, size.split(","))
+    return int(size)
+
+def _search_http(host, what, offset, found):
+    """Search the static host for what starting at offset, the (url, size,
+    mtime) of the results and the offset of the next page go to the
+    queue found, followed by None once done"""
+    url = "http://%s/__search__?%s" % (host,
+            urllib.urlencode({"q": what, "from": offset}))
+    try:
+        f = urllib2.urlopen(url)
+        try:
+            for line in f:
+                result = simplejson.loads(line)
+                if isinstance(result, dict):
+                    found.put((host, int(result["next"])))
+                else:
+                    path, size, mtime = result
+                    url = "http://%s/%s" % (host,
+                            urllib2.quote(path.encode("utf-8")))
+                    found.put((host, (url, size, mtime)))
+        finally:
+            f.close()
+    except (IOError, ValueError, KeyError, TypeError), e:
+        logger.debug("Could not search %s: %r", host, e)
+    found.put((host, None))
 
 def ls(url):
     """list url contents"""
@@ -158,25 +288,46 @@ def ls_l(url):
     """list url contents returns a list of (url, size, icon) tuples"""
     if not url.endswith("/"):
         url += "/"
+    return list(long_entries(url, get_json(url)))
+
+def iter_ls_l(url):
+    """like ls_l but yields the (url, size, icon) tuples as they arrive"""
+    if not url.endswith("/"):
+        url += "/"
+    return long_entries(url, iter_json(url))
+
+def long_entries(url, entries):
+    """yields the (url, size, icon) of the listing entries of url"""
     # converting f from unicode to string because urllib.quote has problems
     # with certain unicode characters
-    files = []
-    for file, size, icon in get_json(url):
+    for file, size, icon in entries:
         fileurl = url + urllib2.quote(file.encode('utf-8'))
         if icon:
             icon = fileurl + icon
-        elif size < config.MAX_IMAGE_SIZE and "." in file and\
-            file[file.rindex(".")+1:].lower() in ("jpg", "png", "jpeg", "gif"):
-            icon = fileurl
-        files.append((fileurl, size, icon))
-    return files
+        else:
+            icon = preview(fileurl, size)
+        yield (fileurl, size, icon)
+
+def preview(url, size):
+    """returns url if it is an image small enough to be used as its icon"""
+    name = url[url.rindex("/")+1:]
+    # directories have a list as size
+    if isinstance(size, (int, long)) and 0 <= size < config.MAX_IMAGE_SIZE \
+            and "." in name and \
+            name[name.rindex(".")+1:].lower() in ("jpg", "png", "jpeg", "gif"):
+        return url
+    return None
 
 def stat(url):
     """list url status returns (size, icon)"""
     # unknown for root url
     if url[:-1].count("/") < 3:
         return (-1, None)
-    for itemurl, size, icon in ls_l(url[:url.rindex("/", 0, -1)]):
+    parent = url[:url.rindex("/", 0, -1) + 1]
+    name = url[len(parent):]
+    # only the entry itself is listed, older daemons list all of them
+    entries = get_json(parent + "?name=" + name)
+    for itemurl, size, icon in long_entries(parent, entries):
             if itemurl == url:
                 return (size, icon)
     # Probably a hidden file
@@ -209,21 +360,134 @@ def reset_cache():
 @cached(config.CACHE_TIMEOUT, 64, stats=config.debug)
 def get_url(url):
     """return contents of url."""
-    f = urllib2.urlopen(url)
+    req = urllib2.Request(url, None, {"Accept-Encoding": "gzip, deflate"})
+    f = decoded(urllib2.urlopen(req))
     contents = f.read()
     f.close()
     return contents
 
+def decoded(response):
+    """returns response, decompressing it if it is gzip or deflate encoded"""
+    if response.headers.get("Content-Encoding") in ("gzip", "deflate"):
+        return DecodedResponse(response)
+    return response
+
+class DecodedResponse(object):
+    """A gzip or deflate encoded response decompressed while it's read"""
+    def __init__(self, response):
+        self.response = response
+        self.headers = response.headers
+        if response.headers.get("Content-Encoding") == "gzip":
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        else:
+            self.decompressor = zlib.decompressobj()
+        self.buffer = ""
+
+    def fill(self):
+        """decompresses the next piece of the response, False at its end"""
+        data = self.response.read(8192)
+        if data:
+            self.buffer += self.decompressor.decompress(data)
+        else:
+            self.buffer += self.decompressor.flush()
+        return bool(data)
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer + \
+                    self.decompressor.decompress(self.response.read()) + \
+                    self.decompressor.flush()
+            self.buffer = ""
+            return data
+        while len(self.buffer) < size and self.fill():
+            pass
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def readline(self):
+        while "\n" not in self.buffer and self.fill():
+            pass
+        end = self.buffer.find("\n") + 1 or len(self.buffer)
+        line, self.buffer = self.buffer[:end], self.buffer[end:]
+        return line
+
+    def close(self):
+        self.response.close()
+
+# url -> (etag, parsed json) of the listings fetched before, unchanged
+# listings only cost a 304 when they are fetched again
+validators = {}
+
 @cached(config.CACHE_TIMEOUT, 2048, stats=config.debug)
 def get_json(url):
     """return parsed json located at url"""
-    req = urllib2.Request(url, None, {"Acccept": "application/json"})
-    f = urllib2.urlopen(req)
+    f, obj = open_json(url)
+    if f:
+        obj = list(read_json(url, f))
+    return obj
+
+def iter_json(url):
+    """
+    yields the entries of the json list located at url as they arrive,
+    unlike get_json it is not cached
+    """
+    f, obj = open_json(url)
+    if f:
+        return read_json(url, f)
+    return iter(obj)
+
+def open_json(url):
+    """
+    requests the json located at url, returns (response, None) or
+    (None, parsed json) if the json fetched before is still valid
+    """
+    req = urllib2.Request(url, None, {"Acccept": "application/json",
+        "Accept-Encoding": "gzip, deflate"})
+    validator = validators.get(url)
+    if validator:
+        req.add_header("If-None-Match", validator[0])
     try:
-        obj = simplejson.load(f)
+        return decoded(urllib2.urlopen(req)), None
+    except urllib2.HTTPError, e:
+        if e.code == 304 and validator:
+            return None, validator[1]
+        raise
+
+def read_json(url, f):
+    """
+    yields the entries of the json list in the response f to url while
+    they arrive and remembers the list for revalidation
+    """
+    entries = []
+    try:
+        for entry in parse_json(f):
+            entries.append(entry)
+            yield entry
     finally:
         f.close()
-    return obj
+    etag = f.headers.get("ETag")
+    if etag:
+        if len(validators) >= 2048:
+            validators.clear()
+        validators[url] = (etag, entries)
+
+def parse_json(f):
+    """
+    yields the entries of the json list read from the file like object f,
+    listings with one entry per line are parsed line by line as they
+    arrive, anything else as a whole
+    """
+    line = f.readline()
+    if line.strip() != "[":
+        for entry in simplejson.loads(line + f.read()):
+            yield entry
+        return
+    for line in iter(f.readline, ""):
+        line = line.strip()
+        if line == "]":
+            return
+        if line:
+            yield simplejson.loads(line.rstrip(","))
 
 
 class DownloadException(Exception):
@@ -275,29 +539,52 @@ def download(url, relpath=None, incoming=config.INCOMING_PATH):
             raise DownloadException("%s is not a directory" % current)
     return do_download(url, downloadpath, localpath, resume)
 
+def open_range(url, offset):
+    """
+    requests url from byte offset on, returns (response, offset) where
+    offset is 0 if the server sent the whole file instead and response
+    is None if there is nothing left after offset
+    """
+    req = urllib2.Request(url)
+    if offset:
+        req.add_header("Range", "bytes=%i-" % offset)
+    try:
+        u = urllib2.urlopen(req)
+    except urllib2.HTTPError, e:
+        if e.code != 416 or \
+                e.headers.get("Content-Range") != "bytes */%i" % offset:
+            raise
+        return None, offset
+    if u.code != 206:
+        return u, 0
+    return u, offset
+
 def do_download(url, downloadpath, localpath, resume):
     """do_download does the dirty work"""
     # download it
     try:
-        req = urllib2.Request(url)
         if resume:
             f = open(downloadpath, "ab")
             # windows is so incredibly dumb that I have to seek to the end
             # of the file manually!!!!
             f.seek(os.path.getsize(downloadpath))
-            req.add_header("Range", "bytes=%i-" % f.tell())
         else:
             f = open(downloadpath, "wb")
         with f:
-            u = urllib2.urlopen(req)
+            u, offset = open_range(url, f.tell())
+            f.seek(offset)
+            f.truncate()
             # the first yield is (localpath, filesize)
-            yield (localpath, int(u.headers.get("Content-Length")) + f.tell())
+            if u:
+                yield (localpath, int(u.headers.get("Content-Length")) + offset)
+            else:
+                yield (localpath, offset)
             # the second yield is amount already downloaded
             yield f.tell()
             # retry 3 times
             for i in range(3):
                 try:
-                    data = u.read(config.DOWNLOAD_BS)
+                    data = u and u.read(config.DOWNLOAD_BS)
                     while data:
                         f.write(data)
                         yield len(data)
@@ -307,9 +594,9 @@ def do_download(url, downloadpath, localpath, resume):
                     logger.exception("Error while downloading %r. Retrying in 10 seconds.", url)
                     # retry every 10 seconds
                     time.sleep(10)
-                    req = urllib2.Request(url)
-                    req.add_header("Range", "bytes=%i-" % f.tell())
-                    u = urllib2.urlopen(req)
+                    u, offset = open_range(url, f.tell())
+                    f.seek(offset)
+                    f.truncate()
             else:
                 logger.error("Download failed after the third retry")
                 raise DownloadException(e.message, e)
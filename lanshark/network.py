@@ -1,5 +1,15 @@
+import re
 import socket
 
+# searches starting with this regex comment ask for their results to be
+# packed into as few datagrams as possible, older daemons ignore it
+BATCH_SEARCH = "(?#batch)"
+# follows BATCH_SEARCH to ask for the results starting at an offset
+SEARCH_OFFSET = "(?#from=%i)"
+search_offset = re.compile(r"\(\?#from=(\d+)\)")
+# the largest udp payload that fits into an ethernet frame
+DATAGRAM_SIZE = 1472
+
 def broadcast_dgram_socket(port):
     """A nonblocking broadcasting udp socket"""
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -1,17 +1,31 @@
 #!/usr/bin/python
 """A Python wrapper arround the linux sendfile64() syscall
 which falls back to a pure python implementation in case
-sendfile 64 is not avaible"""
+sendfile 64 is not avaible. sendsome() does a single non blocking
+call for event loops"""
+import errno
 import sys
 import select
+import socket
 
-def _sendfile(sock, fileobj):
-    while True:
-        buf = fileobj.read(16384)
+def _sendfile(sock, fileobj, count=None):
+    while count is None or count > 0:
+        if count is None:
+            buf = fileobj.read(16384)
+        else:
+            buf = fileobj.read(min(count, 16384))
+            count -= len(buf)
         if not buf:
             break
         sock.sendall(buf)
 
+def _sendsome(sock, fileobj, offset, count):
+    fileobj.seek(offset)
+    buf = fileobj.read(min(count, 65536))
+    if not buf:
+        return 0
+    return sock.send(buf)
+
 if sys.platform == "linux2":
     import ctypes as c
     try:
@@ -22,25 +36,62 @@ if sys.platform == "linux2":
                 e = OSError()
                 e.errno = libc.__errno_location().contents.value
                 raise e
+            return result
         sendfile64 = c.cdll.LoadLibrary('libc.so.6').sendfile64
         sendfile64.argtypes = [c.c_int, c.c_int, c.POINTER(c.c_longlong), c.c_longlong]
         sendfile64.errcheck = errnocheck
-        sendfile64.restype = c.c_int
+        sendfile64.restype = c.c_longlong
     except AttributeError, e:
         sendfile = _sendfile
+        sendsome = _sendsome
     else:
-        def sendfile(sock, fileobj):
+        def sendfile(sock, fileobj, count=None):
+            """
+            sends count bytes (or everything up to the end) of fileobj
+            starting at its current position to sock
+            """
             if not hasattr(fileobj, "fileno"):
-                _sendfile(sock, fileobj)
+                _sendfile(sock, fileobj, count)
                 return
             offset = c.c_longlong(fileobj.tell())
-            # seek backwards
-            fileobj.seek(0, 2)
-            size = fileobj.tell()
-            sock.setblocking(1)
-            sendfile64(sock.fileno(), fileobj.fileno(), c.byref(offset), c.c_longlong(size - offset.value))
+            if count is None:
+                fileobj.seek(0, 2)
+                count = fileobj.tell() - offset.value
+            # sockets with a timeout are non blocking underneath,
+            # wait for them like socket.sendall does
+            timeout = sock.gettimeout()
+            # sendfile64 might send less than requested
+            while count > 0:
+                try:
+                    sent = sendfile64(sock.fileno(), fileobj.fileno(),
+                            c.byref(offset), c.c_longlong(count))
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    if not select.select([], [sock], [], timeout)[1]:
+                        raise socket.timeout("timed out")
+                    continue
+                if not sent:
+                    break
+                count -= sent
+            fileobj.seek(offset.value)
+
+        def sendsome(sock, fileobj, offset, count):
+            """
+            sends up to count bytes of fileobj starting at offset to the
+            non blocking socket sock, returns the number of bytes sent
+            which is 0 at the end of the file. raises an error with errno
+            EAGAIN if sock can't take any data right now
+            """
+            if not hasattr(fileobj, "fileno"):
+                return _sendsome(sock, fileobj, offset, count)
+            return sendfile64(sock.fileno(), fileobj.fileno(),
+                    c.byref(c.c_longlong(offset)), c.c_longlong(count))
 else:
     sendfile = _sendfile
+    sendsome = _sendsome
 
 def test():
     import socket, tempfile
@@ -55,7 +106,7 @@ def test():
         else:
             print "using native systemcall"
         f = tempfile.TemporaryFile()
-        f.write("ttest")
+        f.write("ttest!")
         f.seek(1)
         ssock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         ssock.setblocking(0)
@@ -71,11 +122,31 @@ def test():
                 raise
         con = ssock.accept()[0]
         assert select.select([], [con], [], 10.0)
+        implementation(con, f, 4)
         implementation(con, f)
+        con.setblocking(0)
+        if implementation == sendfile:
+            assert sendsome(con, f, 5, 1) == 1
+        else:
+            assert _sendsome(con, f, 5, 1) == 1
         assert select.select([csock], [], [], 10.0)
-        text = csock.recv(4)
+        text = ""
+        while len(text) < 6 and select.select([csock], [], [], 10.0)[0]:
+            text += csock.recv(6 - len(text))
         print "recived", text
-        assert text == "test"
+        assert text == "test!!"
+        # the timeout of the socket holds for a reader that stops reading
+        f = tempfile.TemporaryFile()
+        f.write("x" * (16 << 20))
+        f.seek(0)
+        con.settimeout(0.2)
+        try:
+            implementation(con, f)
+        except socket.timeout:
+            pass
+        else:
+            raise AssertionError("sent to a stalled reader")
+        assert con.gettimeout() == 0.2
         csock.close()
         ssock.close()
         print "done"
@@ -1,10 +1,14 @@
 #!/usr/bin/python
 # vim: set fileencoding=utf-8 :
 import os
+import re
 import unittest
-import urllib
+import urllib, urllib2
 import tempfile, time
 import random
+import threading
+
+import simplejson
 
 from lanshark.config import config
 
@@ -15,10 +19,12 @@ config.INCOMING_PATH = os.path.join(config.SHARE_PATH, "incoming")
 config.MAX_SEARCH_RESULTS = 5
 config.SEARCH_TIMEOUT = 0.5
 config.DISCOVER_TIMEOUT = 0.5
+config.INDEX_FILE = ""
 
 from lanshark import lib
 from lanshark import icons
 from lanshark import configuration
+from lanshark import network
 
 def rm_r(path):
     if not os.path.isdir(path):
@@ -77,12 +83,30 @@ class LibTestCase(unittest.TestCase):
         self.assertEquals(len(list(lib.search(u"fooö"))), 1)
         self.assertEquals(len(list(lib.search("\\.invisible"))), 0)
         self.assertEquals(len(list(lib.search("huge"))), 2)
+        # several wildcards are expensive but answered
+        self.assertEquals(len(list(lib.search("h.*u.*g.*e$"))), 2)
+        self.assertEquals([size for url, size, mtime in
+            lib.search("huge", stat=True)], [self.huge_size] * 2)
+        self.assertEquals([size for url, size, mtime in
+            lib.search("Foo/", stat=True)], [[1, 2]])
         foo = sorted(lib.search("foo"))
         self.assertEquals(len(foo), 2)
         self.assert_(foo[0].endswith("/"))
         self.assertEquals(sorted(lib.search('')), sorted(lib.search('')))
         self.assertEquals(len(list(lib.search(""))), config.MAX_SEARCH_RESULTS)
 
+    def test_search_folder_size(self):
+        # hidden files count neither in searches nor in listings
+        open(os.path.join(config.SHARE_PATH, "Foo", ".folder.png"),
+                "w").close()
+        daemon.fileindex.update()
+        self.assertEquals([size for url, size, mtime in
+            lib.search("Foo/", stat=True)], [[1, 2]])
+        lib.reset_cache()
+        size, icon = lib.stat(self.url + "Foo/")
+        self.assertEquals(size, [1, 2])
+        self.assert_(icon.endswith(".folder.png"))
+
     def test_search_async(self):
         daemon.fileindex.update()
         start = time.time()
@@ -102,6 +126,65 @@ class LibTestCase(unittest.TestCase):
         self.assertEquals(sorted(filter(None, lib.search("foo", True))),
                               sorted(lib.search("foo")))
 
+    def test_search_unbatched(self):
+        daemon.fileindex.update()
+        sock = network.broadcast_dgram_socket(config.CLIENT_PORT)
+        sock.sendto("search %s huge" % config.NETWORK_NAME,
+                (config.BROADCAST_IP, config.PORT))
+        replies = sorted(msg for msg, addr in
+                lib.recv(sock, config.SEARCH_TIMEOUT, False))
+        self.assertEquals(replies, ["huge:Foo/bar/huge", "huge:huge"])
+
+    def test_search_more(self):
+        daemon.fileindex.update()
+        more = {}
+        first = list(lib.search("", more=more))
+        self.assertEquals(len(first), config.MAX_SEARCH_RESULTS)
+        self.assertEquals(len(more), 1)
+        rest = list(lib.search_more("", more))
+        self.assertEquals(more, {})
+        self.assertEquals(len(set(first + rest)), 9)
+
+    def test_search_http(self):
+        daemon.fileindex.update()
+        lines = lib.get_url(self.url + "__search__?q=huge").splitlines()
+        self.assertEquals(sorted(simplejson.loads(line)[:2]
+            for line in lines), [[u"Foo/bar/huge", self.huge_size],
+                [u"huge", self.huge_size]])
+        # HTTP/1.0 clients get the lines without chunks
+        import socket
+        sock = socket.create_connection(("localhost", config.PORT))
+        sock.sendall("GET /__search__?q=huge HTTP/1.0\r\n\r\n")
+        head, body = sock.makefile().read().split("\r\n\r\n", 1)
+        sock.close()
+        self.assert_("Transfer-Encoding" not in head)
+        self.assertEquals(sorted(body.splitlines()), sorted(lines))
+        # static hosts are searched using http
+        host = "127.0.0.1:%i" % config.PORT
+        more = {host: 0}
+        start = time.time()
+        results = list(lib.search_more("", more))
+        # no waiting for the timeout once the host answered
+        self.assert_(time.time() - start < config.SEARCH_TIMEOUT)
+        self.assertEquals(len(results), config.MAX_SEARCH_RESULTS)
+        self.assertEquals(more, {host: config.MAX_SEARCH_RESULTS})
+        results += lib.search_more("", more)
+        self.assertEquals(more, {})
+        self.assertEquals(len(set(results)), 9)
+        self.assert_(all(result.startswith("http://%s/" % host)
+            for result in results))
+
+    def test_search_stale(self):
+        udpservice = daemon.udpservice
+        dropped = udpservice.dropped
+        udpservice.fast_lane.put("127.0.0.1", (time.time() - 60, "huge",
+            re.compile("huge"), ("127.0.0.1", config.CLIENT_PORT), False, 0))
+        for i in xrange(100):
+            if udpservice.dropped > dropped:
+                break
+            time.sleep(0.01)
+        self.assertEquals(udpservice.dropped, dropped + 1)
+
     def test_get_url(self):
         url = (self.url + u"fooö").encode("utf8")
         print repr(url)
@@ -134,6 +217,294 @@ class LibTestCase(unittest.TestCase):
         self.assertEquals(len(downloaded_data), len(shared_data))
         self.assertEquals(downloaded_data, shared_data)
 
+    def test_resume_complete(self):
+        path = "Foo/bar/huge"
+        download = lib.download(self.url + path)
+        name, bytes = download.next()
+        self.assertEquals(sum(download), bytes)
+        os.rename(name, name + ".part")
+        download = lib.download(self.url + path)
+        self.assertEquals(download.next(), (name, bytes))
+        self.assertEquals(download.next(), bytes)
+        self.assertEquals(sum(download), 0)
+        self.assertEquals(os.path.getsize(name), bytes)
+
+    def get_range(self, path, range):
+        req = urllib2.Request(self.url + path)
+        req.add_header("Range", range)
+        return urllib2.urlopen(req)
+
+    def test_range(self):
+        data = open(os.path.join(config.SHARE_PATH, "huge")).read()
+        u = self.get_range("huge", "bytes=10-19")
+        self.assertEquals(u.code, 206)
+        self.assertEquals(u.headers["Accept-Ranges"], "bytes")
+        self.assertEquals(u.headers["Content-Range"],
+                "bytes 10-19/%i" % self.huge_size)
+        self.assertEquals(u.read(), data[10:20])
+        u = self.get_range("huge", "bytes=-5")
+        self.assertEquals(u.headers["Content-Range"],
+                "bytes %i-%i/%i" % (self.huge_size - 5, self.huge_size - 1,
+                    self.huge_size))
+        self.assertEquals(u.read(), data[-5:])
+        u = self.get_range("huge", "bytes=100-")
+        self.assertEquals(u.read(), data[100:])
+        # ignored
+        u = self.get_range("huge", "bytes=20-10")
+        self.assertEquals(u.code, 200)
+        self.assertEquals(u.read(), data)
+        try:
+            self.get_range("huge", "bytes=%i-" % self.huge_size)
+            self.assert_(False)
+        except urllib2.HTTPError, e:
+            self.assertEquals(e.code, 416)
+            self.assertEquals(e.headers["Content-Range"],
+                    "bytes */%i" % self.huge_size)
+
+    def test_multirange(self):
+        import email
+        data = open(os.path.join(config.SHARE_PATH, "huge")).read()
+        u = self.get_range("huge", "bytes=0-1, 100-199,-3")
+        self.assertEquals(u.code, 206)
+        body = u.read()
+        self.assertEquals(len(body), int(u.headers["Content-Length"]))
+        message = email.message_from_string("Content-Type: %s\r\n\r\n%s" %
+                (u.headers["Content-Type"], body))
+        self.assertEquals(message.get_content_type(), "multipart/byteranges")
+        parts = message.get_payload()
+        self.assertEquals([part["Content-Range"] for part in parts],
+                ["bytes 0-1/%i" % self.huge_size,
+                 "bytes 100-199/%i" % self.huge_size,
+                 "bytes %i-%i/%i" % (self.huge_size - 3, self.huge_size - 1,
+                     self.huge_size)])
+        self.assertEquals([part.get_payload() for part in parts],
+                [data[0:2], data[100:200], data[-3:]])
+
+    def get_validated(self, path, **headers):
+        req = urllib2.Request(self.url + path)
+        for header, value in headers.items():
+            req.add_header(header.replace("_", "-"), value)
+        try:
+            return urllib2.urlopen(req).code
+        except urllib2.HTTPError, e:
+            return e.code
+
+    def test_conditional_get(self):
+        u = urllib2.urlopen(self.url + "huge")
+        etag = u.headers["ETag"]
+        mtime = u.headers["Last-Modified"]
+        u.close()
+        self.assertEquals(self.get_validated("huge", If_None_Match=etag), 304)
+        self.assertEquals(self.get_validated("huge", If_None_Match='"x", *'),
+                304)
+        self.assertEquals(self.get_validated("huge", If_None_Match='"x"'), 200)
+        self.assertEquals(self.get_validated("huge", If_Modified_Since=mtime),
+                304)
+        self.assertEquals(self.get_validated("huge",
+            If_Modified_Since="Sat, 01 Jan 2000 00:00:00 GMT"), 200)
+        # a changed file is sent as a whole
+        self.assertEquals(self.get_validated("huge", Range="bytes=0-9",
+            If_Range=etag), 206)
+        self.assertEquals(self.get_validated("huge", Range="bytes=0-9",
+            If_Range='"x"'), 200)
+        u = urllib2.urlopen(self.url + "Foo/")
+        etag = u.headers["ETag"]
+        u.close()
+        self.assertEquals(self.get_validated("Foo/", If_None_Match=etag), 304)
+        open(os.path.join(config.SHARE_PATH, "Foo", "new"), "w").close()
+        self.assertEquals(self.get_validated("Foo/", If_None_Match=etag), 200)
+
+    def test_keep_alive_without_body(self):
+        import httplib
+        connection = httplib.HTTPConnection("localhost", config.PORT)
+        connection.request("GET", "/huge")
+        response = connection.getresponse()
+        etag = response.getheader("ETag")
+        response.read()
+        connection.request("GET", "/huge", headers={"If-None-Match": etag})
+        response = connection.getresponse()
+        self.assertEquals(response.status, 304)
+        response.read()
+        connection.request("GET", "/huge",
+                headers={"Range": "bytes=%i-" % self.huge_size})
+        response = connection.getresponse()
+        self.assertEquals(response.status, 416)
+        response.read()
+        # the connection is still open
+        connection.request("GET", "/huge", headers={"Range": "bytes=0-1"})
+        response = connection.getresponse()
+        self.assertEquals(response.status, 206)
+        self.assertEquals(len(response.read()), 2)
+        connection.close()
+
+    def test_get_json_revalidation(self):
+        listing = lib.get_json(self.url + "Foo/")
+        lib.reset_cache()
+        # answered by a 304, the entries are reused
+        self.assert_(lib.get_json(self.url + "Foo/")[0] is listing[0])
+        open(os.path.join(config.SHARE_PATH, "Foo", "new"), "w").close()
+        lib.reset_cache()
+        self.assertEquals(len(lib.get_json(self.url + "Foo/")),
+                len(listing) + 1)
+
+    def test_listing_cache(self):
+        listings = daemon.httpservice.listings
+        foo = os.path.join(config.SHARE_PATH, "Foo")
+        bar = os.path.join(foo, "bar")
+        # recently changed directories are not cached
+        past = time.time() - 60
+        for path in (foo, bar):
+            os.utime(path, (past, past))
+        listing = lib.get_json(self.url + "Foo/")
+        key = (foo, "application/json", "/Foo/", "name", 0, None)
+        self.assert_(listings.get(key))
+        # lookups of single entries are not cached
+        cached = len(listings.listings)
+        self.assertEquals(lib.get_json(self.url + "Foo/?name=bar")[0][0],
+                u"bar/")
+        self.assertEquals(len(listings.listings), cached)
+        lib.reset_cache()
+        lib.validators.clear()
+        self.assertEquals(lib.get_json(self.url + "Foo/"), listing)
+        # a changed subdirectory invalidates the listing
+        open(os.path.join(bar, "new"), "w").close()
+        self.assertEquals(listings.get(key), None)
+        lib.reset_cache()
+        self.assertEquals(dict((name, size) for name, size, icon in
+            lib.get_json(self.url + "Foo/"))[u"bar/"], [0, 3])
+
+    def test_streamed_listing(self):
+        from lanshark.daemon import HTTPRequestHandler
+        big = os.path.join(config.SHARE_PATH, "big")
+        os.mkdir(big)
+        names = sorted("%04i" % i for i in
+                xrange(HTTPRequestHandler.stream_entries + 1))
+        for name in names:
+            open(os.path.join(big, name), "w").close()
+        past = time.time() - 60
+        os.utime(big, (past, past))
+        u = urllib2.urlopen(self.url + "big/")
+        self.assertEquals(u.headers["Transfer-Encoding"], "chunked")
+        self.assertEquals(simplejson.load(u), [[name, 0, None]
+            for name in names])
+        # the streamed listing was cached
+        u = urllib2.urlopen(self.url + "big/")
+        self.assert_("Transfer-Encoding" not in u.headers)
+        self.assert_("ETag" in u.headers)
+        body = u.read()
+        self.assertEquals(len(body), int(u.headers["Content-Length"]))
+        self.assertEquals(simplejson.loads(body), [[name, 0, None]
+            for name in names])
+        entries = lib.iter_ls_l(self.url + "big")
+        self.assertEquals(entries.next(), (self.url + "big/0000", 0, None))
+        self.assertEquals(len(list(entries)), len(names) - 1)
+        self.assertEquals(lib.ls_l(self.url + "big/")[-1],
+                (self.url + "big/" + names[-1], 0, None))
+
+    def test_listing_query(self):
+        def names(query):
+            return [entry[0] for entry in
+                    lib.get_json(self.url + "Foo/bar/?" + query)]
+        bar = os.path.join(config.SHARE_PATH, "Foo", "bar")
+        os.mkdir(os.path.join(bar, "eggs"))
+        past = time.time() - 60
+        os.utime(os.path.join(bar, "spam"), (past, past))
+        self.assertEquals(names(""), ["eggs/", "huge", "spam"])
+        self.assertEquals(names("offset=1"), ["huge", "spam"])
+        self.assertEquals(names("offset=1&limit=1"), ["huge"])
+        self.assertEquals(names("limit=0"), [])
+        self.assertEquals(names("sort=-name"), ["spam", "huge", "eggs/"])
+        self.assertEquals(names("sort=size"), ["eggs/", "spam", "huge"])
+        self.assertEquals(names("sort=-size&limit=1"), ["huge"])
+        self.assertEquals(names("sort=mtime")[0], "spam")
+        self.assertEquals(lib.get_json(self.url + "Foo/bar/?name=huge"),
+                [["huge", self.huge_size, None]])
+        self.assertEquals(names("name=eggs/"), ["eggs/"])
+        self.assertEquals(names("name=missing"), [])
+        for query in ("offset=-1", "limit=x", "sort=color", "name=..",
+                "name=eggs/../huge"):
+            try:
+                lib.get_json(self.url + "Foo/bar/?" + query)
+                self.assert_(False)
+            except urllib2.HTTPError, e:
+                self.assertEquals(e.code, 400)
+
+    def test_compressed_listing(self):
+        import zlib
+        many = os.path.join(config.SHARE_PATH, "many")
+        os.mkdir(many)
+        for i in xrange(100):
+            open(os.path.join(many, "file%03i" % i), "w").close()
+        body = urllib2.urlopen(self.url + "many/").read()
+        for encoding, wbits in (("gzip", 16 + zlib.MAX_WBITS),
+                ("deflate", zlib.MAX_WBITS)):
+            req = urllib2.Request(self.url + "many/")
+            req.add_header("Accept-Encoding", "identity, %s;q=0.5" % encoding)
+            u = urllib2.urlopen(req)
+            self.assertEquals(u.headers["Content-Encoding"], encoding)
+            self.assertEquals(zlib.decompress(u.read(), wbits), body)
+            etag = u.headers["ETag"]
+            self.assert_(etag.endswith('-%s"' % encoding))
+            self.assertEquals(self.get_validated("many/",
+                Accept_Encoding=encoding, If_None_Match=etag), 304)
+        req = urllib2.Request(self.url + "many/")
+        req.add_header("Accept-Encoding", "gzip;q=0, deflate;q=0")
+        self.assertEquals(urllib2.urlopen(req).read(), body)
+        self.assertEquals(len(lib.get_json(self.url + "many/")), 100)
+
+    def test_compressed_data(self):
+        import zlib
+        data_path = config.DATA_PATH
+        config.DATA_PATH = os.path.join(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))), "share", "lanshark")
+        try:
+            data = open(os.path.join(config.DATA_PATH, "jquery.js")).read()
+            req = urllib2.Request(self.url + "__data__/jquery.js")
+            req.add_header("Accept-Encoding", "gzip")
+            u = urllib2.urlopen(req)
+            self.assertEquals(u.headers["Content-Encoding"], "gzip")
+            compressed = u.read()
+            self.assert_(len(compressed) < len(data))
+            self.assertEquals(zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+                    data)
+            self.assertEquals(lib.get_url(self.url + "__data__/jquery.js"),
+                    data)
+            # ranges are served from the file itself
+            u = self.get_range("__data__/jquery.js", "bytes=0-9")
+            self.assertEquals(u.read(), data[:10])
+        finally:
+            config.DATA_PATH = data_path
+
+    def test_static_data(self):
+        data_path = config.DATA_PATH
+        config.DATA_PATH = os.path.join(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))), "share", "lanshark")
+        try:
+            path = os.path.join(config.DATA_PATH, "thickbox.css")
+            u = urllib2.urlopen(self.url + "__data__/thickbox.css")
+            self.assertEquals(u.headers["Cache-Control"],
+                    "public, max-age=3600")
+            self.assertEquals(u.read(), open(path).read())
+            self.assert_(path in daemon.httpservice.static.files)
+            u = urllib2.urlopen(self.url + "__data__/thickbox.css?v=1")
+            self.assert_("immutable" in u.headers["Cache-Control"])
+            req = urllib2.Request(self.url, None, {"Accept": "text/html"})
+            html = urllib2.urlopen(req).read()
+            self.assert_("/__data__/thickbox.css?v=%x" %
+                    int(os.path.getmtime(path)) in html)
+            factory = icons.URLIconFactory(os.path.join(config.DATA_PATH,
+                "icons", "32x32"), "/icons/", ".png", versioned=True)
+            self.assert_(factory.get_icon("folder").startswith(
+                "/icons/folder.png?v="))
+        finally:
+            config.DATA_PATH = data_path
+
+    def test_parse_json(self):
+        from StringIO import StringIO
+        for data in ('[[1], [2]]', '[\n[1],\n[2]\n]\n'):
+            self.assertEquals(list(lib.parse_json(StringIO(data))),
+                    [[1], [2]])
+
     def test_download_404(self):
         try:
             lib.download(self.url + "does_not_exists").next()
@@ -180,6 +551,493 @@ class LibTestCase(unittest.TestCase):
     def runTest(self):
         pass
 
+class FileIndexTestCase(unittest.TestCase):
+    def setUp(self):
+        from lanshark.daemon import FileIndex
+        self.path = tempfile.mkdtemp()
+        for name in ["a/", "a/b/", "a/b/spam", "eggs", ".hidden"]:
+            name = os.path.join(self.path, name.replace("/", os.path.sep))
+            if name.endswith(os.path.sep):
+                os.mkdir(name)
+            else:
+                open(name, "w").close()
+        # make the directories look unchanged for a while
+        past = time.time() - 60
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            os.utime(dirpath, (past, past))
+        # rescans are driven by the tests
+        self.index_inotify = config.INDEX_INOTIFY
+        config.INDEX_INOTIFY = False
+        self.fileindex = FileIndex(self.path)
+        self.fileindex.index_event.wait()
+
+    def search(self, what):
+        return sorted(result[0][len(self.fileindex.path):] for result in
+                self.fileindex.search(re.compile(what, re.IGNORECASE)))
+
+    def test_search(self):
+        self.assertEquals(self.search("spam"), ["a/b/spam"])
+        self.assertEquals(self.search(".*s"), ["a/b/spam", "eggs"])
+        self.assertEquals(self.search("\\.hidden"), [])
+        self.assertEquals(self.search(".*PAM"), ["a/b/spam"])
+        self.assertEquals(self.search("EGG"), ["eggs"])
+        self.assertEquals(self.search("ggs"), [])
+        self.assertEquals(self.search(u"eggs\xe4"), [])
+
+    def test_search_cache(self):
+        fileindex = self.fileindex
+        exp = re.compile("spam", re.IGNORECASE)
+        results = fileindex.search(exp)
+        self.assert_(fileindex.search(exp) is results)
+        open(os.path.join(self.path, "spam"), "w").close()
+        fileindex.rescan()
+        self.assertEquals(sorted(result[0] for result in
+            fileindex.search(exp)), sorted([result[0] for result in results]
+                + [fileindex.path + "spam"]))
+
+    def test_search_stat(self):
+        path = os.path.join(self.path, "eggs")
+        open(path, "w").write("12345")
+        self.assertEquals(self.fileindex.search(re.compile("eggs")),
+                ((self.fileindex.path + "eggs", 5,
+                    int(os.stat(path).st_mtime)), ))
+        self.assertEquals(self.fileindex.search(re.compile("a/"))[0][1],
+                (1, 0))
+        os.remove(path)
+        self.fileindex.generation += 1
+        self.assertEquals(self.fileindex.search(re.compile("eggs")), ())
+
+    def test_trigrams(self):
+        from lanshark.daemon import literals
+        self.assertEquals(literals(u".*foo(bar)+baz?[sp]x*y"),
+                [u"foo", u"bar", u"ba", u"y"])
+        self.assertEquals(literals(u"a|foo"), [])
+        names = self.fileindex.file_index
+        def candidates(fragments):
+            return [names.nodes[id][0][len(self.fileindex.path):]
+                    for id in names.candidates(fragments)]
+        self.assertEquals(candidates([u"PAM"]), ["a/b/"])
+        self.assertEquals(candidates([u"gs", u"eggs"]), [""])
+        self.assertEquals(names.candidates([u"sp", u"am"]), None)
+
+    def test_patch(self):
+        from lanshark.daemon import NameIndex
+        index = NameIndex()
+        self.assert_(index.patch({"/a/": "spam\0eggs"}) is index)
+        running = index.search(re.compile(u".*a"))
+        self.assertEquals(running.next(), u"/a/spam")
+        index.patch({"/a/": None, "/b/": "ham"})
+        # the running search keeps its snapshot
+        self.assertEquals(list(running), [])
+        self.assertEquals(list(index.search(re.compile(u".*a"))),
+                [u"/b/ham"])
+        self.assertEquals(list(index.search(re.compile(u"ham"))),
+                [u"/b/ham"])
+
+    def test_overlay(self):
+        from lanshark.daemon import Overlay
+        base = {"a": 1, "b": 2}
+        overlay = Overlay(base)
+        overlay["a"] = 3
+        del overlay["b"]
+        overlay["c"] = 4
+        self.assertEquals(base, {"a": 1, "b": 2})
+        self.assertEquals((overlay["a"], "b" in overlay, overlay.get("b"),
+            overlay["c"]), (3, False, None, 4))
+        self.assertRaises(KeyError, overlay.__delitem__, "b")
+        self.assert_(overlay.merge() is base)
+        self.assertEquals(base, {"a": 3, "c": 4})
+
+    def test_classify(self):
+        from lanshark.daemon import classify, CHEAP, EXPENSIVE, PATHOLOGICAL
+        self.assertEquals(classify(u"spam", re.IGNORECASE), CHEAP)
+        self.assertEquals(classify(u".*spam", re.IGNORECASE), CHEAP)
+        self.assertEquals(classify(u".*s", re.IGNORECASE), EXPENSIVE)
+        self.assertEquals(classify(u"(\\d{2})+", 0), EXPENSIVE)
+        self.assertEquals(classify(u"(a+)+b", 0), PATHOLOGICAL)
+        self.assertEquals(classify(u"x|(y|(.*a)*)b", 0), PATHOLOGICAL)
+        self.assertEquals(classify(u"(a|aa)+b", 0), PATHOLOGICAL)
+        self.assertEquals(classify(u"(ab|a.)*x", 0), PATHOLOGICAL)
+        self.assertEquals(classify(u"(.*a){8}x", 0), EXPENSIVE)
+        self.assertEquals(classify(u".*.*.*.*.*.*.*.*x", 0), EXPENSIVE)
+        self.assertEquals(classify(u"(ab|cd)*x", 0), EXPENSIVE)
+        self.assertEquals(classify(u".*.*.*x", 0), EXPENSIVE)
+        self.assertEquals(classify(u"beatles.*abbey.*road.*flac",
+            re.IGNORECASE), EXPENSIVE)
+        self.assertEquals(classify(u"(cd|disc) ?\\d+.*\\.mp3", 0), EXPENSIVE)
+        self.assertEquals(classify(u"[a-z]+ [a-z]+ [a-z]+\\.txt", 0),
+                EXPENSIVE)
+        self.assertEquals(classify(u"(foo|bar)*baz", 0), CHEAP)
+        # the patterns of the gui
+        self.assertEquals(classify(u".*spam.*\\/", 0), CHEAP)
+        self.assertEquals(classify(u"s.*\\.(avi|mpg)$", 0), EXPENSIVE)
+        self.assertEquals(classify(u".*spam.*eggs.*", 0), CHEAP)
+        self.assertEquals(classify(u"(a|b)+.*x", 0), EXPENSIVE)
+        names = self.fileindex.file_index
+        self.assertEquals(list(names.search(re.compile(".*"),
+            time.time() - 1)), [])
+
+    def test_rescan(self):
+        fileindex = self.fileindex
+        listed = []
+        listdir = fileindex.listdir
+        fileindex.listdir = lambda path: listed.append(path) or listdir(path)
+        generation = fileindex.generation
+        fileindex.rescan()
+        self.assertEquals(listed, [])
+        self.assertEquals(fileindex.generation, generation)
+        os.mkdir(os.path.join(self.path, "a", "ham"))
+        os.remove(os.path.join(self.path, "a", "b", "spam"))
+        fileindex.rescan()
+        self.assertEquals(sorted(listed), [fileindex.path + "a/",
+            fileindex.path + "a/b/", fileindex.path + "a/ham/"])
+        self.assert_(fileindex.generation > generation)
+        self.assertEquals(self.search("spam"), [])
+        self.assertEquals(self.search("ham"), ["a/ham/"])
+        rm_r(os.path.join(self.path, "a"))
+        fileindex.rescan()
+        self.assertEquals(self.search(".*"), ["eggs"])
+
+    def test_walk(self):
+        fileindex = self.fileindex
+        loop = os.path.join(self.path, "a", "b", "loop")
+        os.symlink(os.path.join(self.path, "a"), loop)
+        os.mkdir(os.path.join(self.path, "a", "ham"))
+        dirs, changed = {}, set()
+        config.INDEX_THREADS = 4
+        try:
+            fileindex.index(fileindex.path, dirs, changed)
+            walked, walked_changed = {}, set()
+            fileindex.walk(fileindex.path, walked, walked_changed)
+        finally:
+            config.INDEX_THREADS = 1
+            os.remove(loop)
+        self.assertEquals(walked, dirs)
+        self.assertEquals(walked_changed, changed)
+        self.assertEquals(sorted(walked), [fileindex.path + path for path in
+            ("", "a/", "a/b/", "a/ham/")])
+        self.assertRaises(OSError, fileindex.walk,
+                os.path.join(self.path, "missing/"), {}, set())
+
+    def test_inotify(self):
+        from lanshark import inotify
+        from lanshark.daemon import FileIndex
+        if not inotify.available:
+            return
+        config.INDEX_INOTIFY = True
+        fileindex = self.fileindex = FileIndex(self.path)
+        fileindex.index_event.wait()
+        def search(what, expected):
+            for i in xrange(100):
+                if self.search(what) == expected:
+                    break
+                time.sleep(0.05)
+            self.assertEquals(self.search(what), expected)
+        os.mkdir(os.path.join(self.path, "a", "ham"))
+        open(os.path.join(self.path, "a", "ham", "spam"), "w").close()
+        search("spam", ["a/b/spam", "a/ham/spam"])
+        os.rename(os.path.join(self.path, "a", "ham"),
+                os.path.join(self.path, "ham"))
+        search("spam", ["a/b/spam", "ham/spam"])
+        os.remove(os.path.join(self.path, "ham", "spam"))
+        search("spam", ["a/b/spam"])
+        rm_r(os.path.join(self.path, "a"))
+        search(".*", ["eggs", "ham/"])
+        # vanished results are left out before the events are applied
+        for i in xrange(100):
+            if len(fileindex.watches) == 2:
+                break
+            time.sleep(0.05)
+        self.assertEquals(sorted(fileindex.watches),
+                [fileindex.path, fileindex.path + "ham/"])
+
+    def test_snapshot(self):
+        from lanshark.daemon import FileIndex
+        class SnapshotIndex(FileIndex):
+            def rescan(self):
+                return False
+        config.INDEX_FILE = os.path.join(self.path, ".fileindex")
+        self.assertFalse(SnapshotIndex(self.path).load())
+        self.fileindex.save()
+        fileindex = SnapshotIndex(self.path)
+        fileindex.index_event.wait()
+        self.assertEquals(fileindex.dirs, self.fileindex.dirs)
+        self.assertEquals(sorted(fileindex.file_index.nodes.values()),
+                sorted(self.fileindex.file_index.nodes.values()))
+        self.assertFalse(SnapshotIndex(os.path.join(self.path, "a")).load())
+        open(config.INDEX_FILE, "wb").write("garbage")
+        self.assertFalse(fileindex.load())
+
+    def test_shards(self):
+        from lanshark.daemon import FileIndex
+        for name in ["a/b/spam2", "ham", "a/spam3"]:
+            open(os.path.join(self.path, name), "w").close()
+        self.fileindex.rescan()
+        expected = [self.search(what) for what in ("spam", ".*a", "x")]
+        config.INDEX_SHARDS = 3
+        try:
+            fileindex = self.fileindex = FileIndex(self.path)
+        finally:
+            config.INDEX_SHARDS = 1
+        try:
+            fileindex.index_event.wait()
+            self.assertEquals([self.search(what)
+                for what in ("spam", ".*a", "x")], expected)
+            self.assertEquals(len(fileindex.file_index.processes), 3)
+            # searches don't wait for each other
+            results = []
+            def search():
+                results.append(self.search(".*a"))
+            threads = [threading.Thread(target=search) for i in xrange(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEquals(results, [expected[1]] * 8)
+            # shards that don't answer in time are left out
+            import signal
+            processes = fileindex.file_index.processes
+            for process in processes:
+                os.kill(process.pid, signal.SIGSTOP)
+            try:
+                start = time.time()
+                self.assertEquals(list(fileindex.file_index.search(
+                    re.compile(".*"), time.time() + 0.1)), [])
+                self.assert_(time.time() - start < 2)
+            finally:
+                for process in processes:
+                    os.kill(process.pid, signal.SIGCONT)
+            self.assertEquals(self.search(".*a"), expected[1])
+            # and dead ones too
+            for process in processes:
+                process.terminate()
+                process.join()
+            self.assertEquals(list(fileindex.file_index.search(
+                re.compile(".*"))), [])
+        finally:
+            fileindex.file_index.close()
+
+    def test_inotify_module(self):
+        from lanshark import inotify
+        inotify.test()
+
+    def test_dirent_module(self):
+        from lanshark import dirent
+        dirent.test()
+
+    def tearDown(self):
+        config.INDEX_INOTIFY = self.index_inotify
+        config.INDEX_FILE = ""
+        rm_r(self.path)
+
+class QueueingTestCase(unittest.TestCase):
+    def test_token_bucket(self):
+        from lanshark.daemon import TokenBucket
+        bucket = TokenBucket(10, 2)
+        self.assertEquals([bucket.take() for i in xrange(3)],
+                [True, True, False])
+        time.sleep(0.15)
+        self.assertEquals([bucket.take() for i in xrange(2)], [True, False])
+
+    def test_fair_queue(self):
+        from lanshark.daemon import FairQueue
+        queue = FairQueue(4)
+        for item in ("a1", "a2", "a3"):
+            self.assertEquals(queue.put("a", item), None)
+        self.assertEquals(queue.put("b", "b1"), None)
+        # the busiest key makes room
+        self.assertEquals(queue.put("b", "b2"), "a1")
+        self.assertEquals([queue.get() for i in xrange(4)],
+                ["a2", "b1", "a3", "b2"])
+        self.assertEquals(queue.size, 0)
+
+class EventHTTPTestCase(unittest.TestCase):
+    service = None
+    size = 100000
+    def setUp(self):
+        from lanshark.daemon import EventHTTPService
+        if EventHTTPTestCase.service is None:
+            EventHTTPTestCase.service = EventHTTPService(config.SHARE_PATH,
+                    port=0)
+            EventHTTPTestCase.service.start()
+        self.port = self.service.server_address[1]
+        self.path = os.path.join(config.SHARE_PATH, "event")
+        os.mkdir(self.path)
+        self.data = "".join(chr(i % 256) for i in xrange(self.size))
+        f = open(os.path.join(self.path, "data"), "wb")
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        rm_r(self.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.service is not None:
+            cls.service.stop()
+            cls.service = None
+
+    def test_keep_alive(self):
+        import httplib
+        connection = httplib.HTTPConnection("localhost", self.port)
+        connection.request("GET", "/event/")
+        response = connection.getresponse()
+        self.assertEquals(simplejson.loads(response.read()),
+                [["data", self.size, None]])
+        connection.request("GET", "/event/data")
+        self.assertEquals(connection.getresponse().read(), self.data)
+        connection.request("GET", "/event/data", headers={"Range": "bytes=5-9"})
+        response = connection.getresponse()
+        self.assertEquals(response.status, 206)
+        self.assertEquals(response.read(), self.data[5:10])
+        connection.request("GET", "/event/data",
+                headers={"Range": "bytes=0-1,-2"})
+        response = connection.getresponse()
+        body = response.read()
+        self.assertEquals(len(body), int(response.getheader("Content-Length")))
+        self.assert_(body.endswith("--\r\n"))
+        connection.request("GET", "/event/missing")
+        self.assertEquals(connection.getresponse().status, 404)
+        connection.close()
+
+    def test_streamed_listing(self):
+        import httplib
+        from lanshark.daemon import HTTPRequestHandler
+        names = sorted("%04i" % i for i in
+                xrange(HTTPRequestHandler.stream_entries + 1))
+        for name in names:
+            open(os.path.join(self.path, name), "w").close()
+        streamed = []
+        def stream(connection, output):
+            streamed.append(output)
+            type(self.service).stream(self.service, connection, output)
+        self.service.stream = stream
+        try:
+            connection = httplib.HTTPConnection("localhost", self.port)
+            connection.request("GET", "/event/")
+            response = connection.getresponse()
+            self.assertEquals(response.getheader("Transfer-Encoding"),
+                    "chunked")
+            self.assertEquals(simplejson.loads(response.read())[:-1],
+                    [[name, 0, None] for name in names])
+            # the chunks are passed to the loop as they are made
+            self.assert_(len(streamed) > 2)
+            connection.request("GET", "/event/data")
+            self.assertEquals(connection.getresponse().read(), self.data)
+            connection.close()
+        finally:
+            del self.service.stream
+
+    def test_pipelining(self):
+        import socket
+        sock = socket.create_connection(("localhost", self.port))
+        sock.sendall("GET /event/data HTTP/1.1\r\n\r\n"
+                "GET /event/data HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = ""
+        data = sock.recv(65536)
+        while data:
+            response += data
+            data = sock.recv(65536)
+        sock.close()
+        self.assertEquals(response.count("HTTP/1.1 200 OK"), 2)
+        self.assertEquals(response.count(self.data), 2)
+
+    def test_idle_connections(self):
+        import socket
+        idle = [socket.create_connection(("localhost", self.port))
+                for i in xrange(100)]
+        try:
+            self.assertEquals(urllib2.urlopen("http://localhost:%i/event/data"
+                % self.port).read(), self.data)
+        finally:
+            for sock in idle:
+                sock.close()
+
+class ThreadPoolTestCase(unittest.TestCase):
+    def test_overload(self):
+        import socket
+        from lanshark.daemon import HTTPService
+        threads, queue = config.HTTP_THREADS, config.HTTP_QUEUE
+        config.HTTP_THREADS, config.HTTP_QUEUE = 1, 1
+        try:
+            service = HTTPService(config.SHARE_PATH, port=0)
+        finally:
+            config.HTTP_THREADS, config.HTTP_QUEUE = threads, queue
+        service.start()
+        address = ("localhost", service.server_address[1])
+        # keeps the only thread waiting for its request
+        busy = socket.create_connection(address)
+        time.sleep(0.1)
+        queued = socket.create_connection(address)
+        time.sleep(0.1)
+        rejected = socket.create_connection(address)
+        rejected.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        response = rejected.makefile().read()
+        rejected.close()
+        self.assert_(response.startswith("HTTP/1.1 503 "))
+        self.assert_("Retry-After: %i\r\n" % service.retry_after in response)
+        self.assertEquals(service.rejected, 1)
+        busy.close()
+        queued.sendall("GET / HTTP/1.1\r\nHost: localhost\r\n"
+                "Connection: close\r\n\r\n")
+        response = queued.makefile().read()
+        queued.close()
+        self.assert_(response.startswith("HTTP/1.1 200 "))
+        service.stop()
+        self.assertRaises(socket.error, socket.create_connection, address)
+
+    def test_idle_after_download(self):
+        import socket
+        from lanshark.daemon import HTTPService, HTTPRequestHandler
+        name = os.path.join(config.SHARE_PATH, "idle")
+        open(name, "wb").write("x" * 1000)
+        threads = config.HTTP_THREADS
+        config.HTTP_THREADS = 1
+        try:
+            service = HTTPService(config.SHARE_PATH, port=0)
+        finally:
+            config.HTTP_THREADS = threads
+        HTTPRequestHandler.timeout = 0.5
+        service.start()
+        try:
+            address = ("localhost", service.server_address[1])
+            # downloads and keeps the connection without another request
+            idle = socket.create_connection(address)
+            idle.sendall("GET /idle HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = ""
+            while not response.endswith("x" * 1000):
+                response += idle.recv(4096)
+            other = socket.create_connection(address)
+            other.settimeout(3)
+            other.sendall("GET /idle HTTP/1.1\r\nHost: localhost\r\n"
+                    "Connection: close\r\n\r\n")
+            response = other.makefile().read()
+            other.close()
+            idle.close()
+            self.assert_(response.startswith("HTTP/1.1 200 "))
+            self.assert_(response.endswith("x" * 1000))
+        finally:
+            HTTPRequestHandler.timeout = None
+            service.stop()
+            os.remove(name)
+
+class RangeTestCase(unittest.TestCase):
+    def test_parse_ranges(self):
+        from lanshark.daemon import parse_ranges
+        self.assertEquals(parse_ranges("bytes=0-9", 100), [(0, 9)])
+        self.assertEquals(parse_ranges("bytes=90-", 100), [(90, 99)])
+        self.assertEquals(parse_ranges("bytes=90-200", 100), [(90, 99)])
+        self.assertEquals(parse_ranges("bytes=-10", 100), [(90, 99)])
+        self.assertEquals(parse_ranges("bytes=-200", 100), [(0, 99)])
+        self.assertEquals(parse_ranges("bytes=50-59, 0-9,5-14,15-19", 100),
+                [(0, 19), (50, 59)])
+        self.assertEquals(parse_ranges("bytes=100-", 100), [])
+        self.assertEquals(parse_ranges("bytes=0-", 0), [])
+        self.assertEquals(parse_ranges("bytes=-0", 100), [])
+        for header in ("bytes=9-0", "bytes=-", "bytes=a-b", "lines=0-9",
+                "bytes=0-0,2-2,4-4"):
+            self.assertEquals(parse_ranges(header, 100, 2), None)
+
 class ByteFormatTestCase(unittest.TestCase):
     def test_byteformat(self):
         assertions = ((0, '0.00 B'), (999, '999.00 B'),
@@ -238,4 +1096,5 @@ if __name__ == "__main__":
         daemon.start()
         unittest.main()
     finally:
+        daemon.stop()
         os.rmdir(config.SHARE_PATH)